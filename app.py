@@ -1,50 +1,129 @@
 # MediAssist Chatbot - Enhanced with ChromaDB RAG
 
 ## Requirements
-# pip install streamlit supabase openai python-dotenv requests chromadb reportlab
+# pip install streamlit supabase python-dotenv requests chromadb reportlab
 
 import streamlit as st
 import json
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 import os
+import hashlib
+import hmac
+import re
+import sqlite3
+import threading
 from typing import Dict, List, Any, Optional
-import requests
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import time
 import io
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-
-# For demo purposes - you'll need to install these packages:
-# pip install supabase openai python-dotenv chromadb reportlab
-
-try:
-    from supabase import create_client, Client
-    import openai
-    from dotenv import load_dotenv
-    import chromadb
-    from chromadb.config import Settings
-    DEPENDENCIES_AVAILABLE = True
-except ImportError:
-    DEPENDENCIES_AVAILABLE = False
+
+# Heavy dependencies (supabase, chromadb, reportlab, requests) are imported at
+# first use so process start and every Streamlit rerun stay cheap; here we only
+# check that they are installed.
+DEPENDENCIES_AVAILABLE = all(find_spec(module) is not None for module in ("supabase", "chromadb", "dotenv"))
+if not DEPENDENCIES_AVAILABLE:
     st.warning("⚠️ Some dependencies not installed. This is a demo version.")
 
 # Load environment variables
 if DEPENDENCIES_AVAILABLE:
+    from dotenv import load_dotenv
     load_dotenv()
 
 # Configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL", "your-supabase-url")
 SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY", "your-supabase-key")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "your-openrouter-key")
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# Storage backend: "supabase" or "sqlite" (local file, for on-prem/offline clinics)
+STORAGE_BACKEND = os.getenv("MEDIASSIST_STORAGE", "supabase")
+SQLITE_PATH = os.getenv("MEDIASSIST_SQLITE_PATH", "./mediassist.db")
+
+# Medical knowledge vector index (ChromaDB)
+CHROMA_PATH = os.getenv("MEDIASSIST_CHROMA_PATH", "./chroma_db")
+COLLECTION_NAME = "medical_knowledge"
+HNSW_M = int(os.getenv("MEDIASSIST_HNSW_M", "16"))
+HNSW_CONSTRUCTION_EF = int(os.getenv("MEDIASSIST_HNSW_CONSTRUCTION_EF", "100"))
+HNSW_SEARCH_EF = int(os.getenv("MEDIASSIST_HNSW_SEARCH_EF", "100"))
+# Split the knowledge base into one collection per category, queried in parallel
+CHROMA_SHARD_BY_CATEGORY = os.getenv("MEDIASSIST_CHROMA_SHARD_BY_CATEGORY", "false").lower() in ("1", "true", "yes")
+
+# Chroma client: "embedded" opens CHROMA_PATH in-process (dev); "http" connects
+# to a shared Chroma server so workers do not each hold their own index
+CHROMA_MODE = os.getenv("MEDIASSIST_CHROMA_MODE", "embedded")
+CHROMA_HOST = os.getenv("MEDIASSIST_CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("MEDIASSIST_CHROMA_PORT", "8000"))
+CHROMA_SSL = os.getenv("MEDIASSIST_CHROMA_SSL", "false").lower() in ("1", "true", "yes")
+
+# Embedding model (ONNX MiniLM) runtime: thread counts of 0 keep onnxruntime's
+# defaults; set them when several workers share a node to avoid oversubscription
+ONNX_INTRA_OP_THREADS = int(os.getenv("MEDIASSIST_ONNX_INTRA_OP_THREADS", "0"))
+ONNX_INTER_OP_THREADS = int(os.getenv("MEDIASSIST_ONNX_INTER_OP_THREADS", "0"))
+# The serving process opens the knowledge index and loads the embedding model in
+# the background from its first script run, and writes READY_FILE once a warm-up
+# query succeeded, for file-based readiness probes (empty disables). Start that
+# first run with `python manage.py warm-up --server http://localhost:8501`.
+EMBEDDING_WARMUP = os.getenv("MEDIASSIST_EMBEDDING_WARMUP", "true").lower() in ("1", "true", "yes")
+READY_FILE = os.getenv("MEDIASSIST_READY_FILE", "")
+
+# Knowledge retrieval backend: "chroma", "numpy" for in-process search over a
+# memory-mapped snapshot exported from Chroma, or "none" for the keyword fallback
+VECTOR_BACKEND = os.getenv("MEDIASSIST_VECTOR_BACKEND", "chroma")
+VECTOR_SNAPSHOT_DIR = os.getenv("MEDIASSIST_VECTOR_SNAPSHOT", "./vector_snapshot")
+
+# Clinician-only views (patient history, clinic dashboard) are hidden from the
+# patient-facing app unless enabled; with an access code set, the sidebar asks for it
+CLINICIAN_VIEWS = os.getenv("MEDIASSIST_CLINICIAN_VIEWS", "false").lower() in ("1", "true", "yes")
+CLINICIAN_ACCESS_CODE = os.getenv("MEDIASSIST_CLINICIAN_ACCESS_CODE", "")
+
+# Questionnaire layout: "grouped" renders related questions as one form page
+# (one rerun per page), "single" asks one question per rerun
+QUESTIONNAIRE_MODE = os.getenv("MEDIASSIST_QUESTIONNAIRE_MODE", "grouped")
+
+# Speculative retrieval: start the knowledge base lookup in the background as
+# soon as the symptom answers are saved, instead of after the last question
+PREFETCH_ENABLED = os.getenv("MEDIASSIST_PREFETCH", "true").lower() in ("1", "true", "yes")
+PREFETCH_WORKERS = int(os.getenv("MEDIASSIST_PREFETCH_WORKERS", "4"))
+
+# Upstream resilience: a dependency's circuit breaker opens after
+# BREAKER_FAILURE_THRESHOLD consecutive failures and lets a single trial call
+# through after BREAKER_RESET_SECONDS. Each assessment has an end-to-end budget
+# of ASSESSMENT_DEADLINE_SECONDS, and every stage is also capped by its own timeout.
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("MEDIASSIST_BREAKER_FAILURES", "3"))
+BREAKER_RESET_SECONDS = float(os.getenv("MEDIASSIST_BREAKER_RESET_SECONDS", "30"))
+ASSESSMENT_DEADLINE_SECONDS = float(os.getenv("MEDIASSIST_DEADLINE_SECONDS", "45"))
+RETRIEVAL_TIMEOUT_SECONDS = float(os.getenv("MEDIASSIST_RETRIEVAL_TIMEOUT", "5"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("MEDIASSIST_LLM_TIMEOUT", "35"))
+STORAGE_TIMEOUT_SECONDS = float(os.getenv("MEDIASSIST_STORAGE_TIMEOUT", "5"))
+# Local SQLite spool for assessments the primary storage could not take; replay
+# it with `python manage.py drain-spool` (empty disables spooling)
+SPOOL_PATH = os.getenv("MEDIASSIST_SPOOL_PATH", "./mediassist_spool.db")
+
+# Deterministic red-flag and medication screening rules, run locally before the LLM
+SAFETY_RULES_PATH = os.getenv("MEDIASSIST_SAFETY_RULES",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "safety_rules.json"))
+
+# Answers the medical knowledge query is built from - each non-empty one is a
+# separate facet query, all sent in one batched call and fused by rank
+CONTEXT_QUERY_KEYS = ["main_symptom", "additional_symptoms", "pain_location",
+                      "medical_history", "allergies", "current_medications"]
+# Rank-fusion weight per facet: the presenting symptoms drive retrieval, history only nudges it
+CONTEXT_QUERY_WEIGHTS = {"main_symptom": 2.0, "additional_symptoms": 1.5, "pain_location": 1.0,
+                         "medical_history": 0.5, "allergies": 0.25, "current_medications": 0.5}
+# Answers that mean "nothing to report" and must not become queries
+PLACEHOLDER_ANSWER = re.compile(
+    r"^\s*(none|none known|no|nope|nil|n/?a|nothing|not applicable|unknown|no known allergies|-+)\s*\.?\s*$",
+    re.IGNORECASE)
 
 @dataclass
 class PatientData:
     name: str = ""
+    date_of_birth: str = ""  # ISO date; age is derived from it
     age: int = 0
     gender: str = ""
     weight: float = 0.0
@@ -66,28 +145,447 @@ class PatientData:
     sleep_patterns: str = ""
     dietary_habits: str = ""
 
-class ChromaDBManager:
+def patient_identity_key(name: str, gender: str, date_of_birth: str) -> str:
+    """Deterministic key identifying a returning patient.
+
+    Hashes the normalised name, gender and ISO date of birth, so the key does
+    not drift as the patient ages. Must stay in sync with the SQL expression
+    used by ``merge_duplicate_patients``.
+    """
+    normalized_name = " ".join(name.split()).lower()
+    raw_key = f"{normalized_name}|{gender.strip().lower()}|{date_of_birth}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+def age_on(date_of_birth: str, today: Optional[date] = None) -> int:
+    """Age in whole years on ``today`` for an ISO date of birth"""
+    born = date.fromisoformat(date_of_birth)
+    today = today or date.today()
+    return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+
+def build_session_record(patient_data: PatientData, diagnosis_result: Dict[str, Any],
+                         session_id: Optional[str] = None) -> Dict[str, Any]:
+    """Flatten an assessment into the record stored by every storage backend"""
+    return {
+        'patient_key': patient_identity_key(patient_data.name, patient_data.gender, patient_data.date_of_birth),
+        'name': patient_data.name,
+        'date_of_birth': patient_data.date_of_birth or None,
+        'age': patient_data.age,
+        'gender': patient_data.gender,
+        'weight': patient_data.weight or None,
+        'height': patient_data.height or None,
+        'answers': asdict(patient_data),
+        'diagnosis': diagnosis_result.get('possible_diagnosis', []),
+        'treatment': diagnosis_result.get('treatment_recommendations', []),
+        'medications': diagnosis_result.get('prescribed_medications', []),
+        'home_remedies': diagnosis_result.get('home_remedies', []),
+        'session_id': session_id,
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+
+@st.cache_resource
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    """Process-wide worker pool shared by all sessions for speculative retrieval"""
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="mediassist-prefetch")
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker for one upstream dependency.
+
+    Closed: calls go through and consecutive failures are counted. Open: calls
+    are rejected immediately until ``reset_timeout`` has passed. Half-open: one
+    trial call is let through; its outcome closes or re-opens the breaker.
+    Callers use ``allow()`` before the call and report the outcome with
+    ``record_success()`` or ``record_failure()``.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._counters = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self._last_change = datetime.now(timezone.utc).isoformat()
+        # Shared by every session thread in the process
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            self._last_change = datetime.now(timezone.utc).isoformat()
+
+    def allow(self) -> bool:
+        """Return True if a call may go to the dependency now"""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state("half_open")
+                self._trial_in_flight = False
+            
+            if self.state == "closed" or (self.state == "half_open" and not self._trial_in_flight):
+                self._trial_in_flight = self.state == "half_open"
+                self._counters["calls"] += 1
+                return True
+            
+            self._counters["rejected"] += 1
+            return False
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls are being rejected; unlike ``allow()`` this never starts a trial call"""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+            self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._counters["failures"] += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self._counters["opened"] += 1
+                self._set_state("open")
+                self._opened_at = time.monotonic()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Current state and counters since process start"""
+        with self._lock:
+            return {"name": self.name, "state": self.state, "consecutive_failures": self.consecutive_failures,
+                    "last_state_change": self._last_change, **self._counters}
+
+@st.cache_resource
+def get_circuit_breakers() -> Dict[str, CircuitBreaker]:
+    """Process-wide breakers, so every session sees the same dependency health"""
+    return {name: CircuitBreaker(name) for name in ("openrouter", "storage", "chroma")}
+
+class Deadline:
+    """End-to-end time budget for one assessment, handed out stage by stage"""
+    
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def stage_timeout(self, cap: float) -> float:
+        """Timeout for the next stage: its own cap, cut short by what is left of the budget"""
+        return min(cap, self.remaining())
+
+def _chroma_client_healthy(client) -> bool:
+    """Health check run on each cache hit; a failed heartbeat makes Streamlit reconnect"""
+    if CHROMA_MODE != "http":
+        return True
+    try:
+        client.heartbeat()
+        return True
+    except Exception:
+        return False
+
+@st.cache_resource(validate=_chroma_client_healthy)
+def get_chroma_client():
+    """One Chroma client per process, reused across sessions and reruns"""
+    import chromadb
+    
+    if CHROMA_MODE == "http":
+        client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT, ssl=CHROMA_SSL)
+        client.heartbeat()  # Fail fast if the server is unreachable
+        return client
+    return chromadb.PersistentClient(path=CHROMA_PATH)
+
+class _ThreadTunedOrt:
+    """Proxy for the onnxruntime module whose SessionOptions carry the configured thread counts"""
+    
+    def __init__(self, ort):
+        self._ort = ort
+
+    def __getattr__(self, name):
+        return getattr(self._ort, name)
+
+    def SessionOptions(self):
+        options = self._ort.SessionOptions()
+        if ONNX_INTRA_OP_THREADS:
+            options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+        if ONNX_INTER_OP_THREADS:
+            options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+        return options
+
+@st.cache_resource
+def get_embedding_function():
+    """Chroma's default ONNX MiniLM embedding function, shared by the whole process.
+
+    Chroma persists the embedding function's name with each collection and refuses
+    to open it with a different one, so this stays a ``DefaultEmbeddingFunction``
+    (name "default", as collections created without one) but embeds with a single
+    thread-tuned ONNX model instead of loading a new one per call.
+    """
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+    from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+    
+    class SharedDefaultEmbeddingFunction(DefaultEmbeddingFunction):
+        def __init__(self, model):
+            super().__init__()
+            self._model = model
+
+        def __call__(self, input):
+            return self._model(input)
+    
+    model = ONNXMiniLM_L6_V2()
+    # The ONNX session is created lazily from self.ort, so thread settings can still be applied
+    if hasattr(model, "ort"):
+        model.ort = _ThreadTunedOrt(model.ort)
+    return SharedDefaultEmbeddingFunction(model)
+
+def warm_up_embeddings():
+    """Load the embedding model (downloading it if needed) and run a dummy embed"""
+    get_embedding_function()(["warm-up"])
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Dict[str, Any]]], k: int = 60,
+                           weights: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+    """Fuse ranked hit lists with reciprocal-rank fusion, deduplicating by document id.
+
+    Each hit scores ``weight / (k + rank)`` per list it appears in (weight 1 by
+    default); documents that rank well for several facets rise to the top.
+    """
+    scores: Dict[str, float] = {}
+    hits_by_id: Dict[str, Dict[str, Any]] = {}
+    for list_index, hits in enumerate(ranked_lists):
+        weight = weights[list_index] if weights else 1.0
+        for rank, hit in enumerate(hits, 1):
+            scores[hit["id"]] = scores.get(hit["id"], 0.0) + weight / (k + rank)
+            hits_by_id.setdefault(hit["id"], hit)
+    return [hits_by_id[doc_id] for doc_id in sorted(scores, key=scores.get, reverse=True)]
+
+@st.cache_resource
+def get_shard_query_executor() -> ThreadPoolExecutor:
+    """Worker pool for parallel shard queries, separate from prefetch so nested waits cannot deadlock"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="mediassist-shard-query")
+
+# Returned by the knowledge queries when the backend raised, so callers can fall back
+RETRIEVAL_ERROR = "Error retrieving medical information."
+
+class KnowledgeIndex(ABC):
+    """Query interface shared by the medical knowledge backends.
+
+    Subclasses provide ``is_available`` and ``_query_batch``, which runs a batch
+    of queries and returns the hits for each one ordered by cosine distance.
+    """
+    
+    backend_name = "knowledge base"
+
+    @property
+    @abstractmethod
+    def is_available(self) -> bool:
+        ...
+
+    @abstractmethod
+    def _query_batch(self, query_texts: Optional[List[str]] = None, n_results: int = 5,
+                     query_embeddings: Optional[List[List[float]]] = None) -> List[List[Dict[str, Any]]]:
+        ...
+
+    def query_medical_knowledge(self, symptoms: str, n_results: int = 5) -> str:
+        """Query ChromaDB for relevant medical information"""
+        if not self.is_available:
+            return "Medical knowledge base not available."
+        
+        try:
+            # Query ChromaDB for relevant documents
+            hits = self._query_batch([symptoms], n_results)[0]
+            
+            if hits:
+                # Combine retrieved documents
+                return " | ".join(hit["document"] for hit in hits)
+            else:
+                return "No specific medical information found for these symptoms."
+                
+        except Exception as e:
+            st.error(f"Error querying medical knowledge: {str(e)}")
+            return RETRIEVAL_ERROR
+
+    def query_medical_knowledge_facets(self, facets: Dict[str, str], n_results: int = 5) -> str:
+        """Query each symptom facet separately in one batched call and fuse the rankings.
+
+        Facets are weighted by ``CONTEXT_QUERY_WEIGHTS``; empty and placeholder
+        answers ("None", "No", ...) are not queried.
+        """
+        if not self.is_available:
+            return "Medical knowledge base not available."
+        
+        facets = {key: str(text).strip() for key, text in facets.items()
+                  if text and str(text).strip() and not PLACEHOLDER_ANSWER.match(str(text))}
+        facet_texts = list(facets.values())
+        if not facet_texts:
+            return "No specific medical information found for these symptoms."
+        
+        try:
+            # One round-trip for all facets (per shard when sharded)
+            ranked_lists = self._query_batch(facet_texts, n_results)
+            weights = [CONTEXT_QUERY_WEIGHTS.get(key, 1.0) for key in facets]
+            hits = reciprocal_rank_fusion(ranked_lists, weights=weights)[:n_results]
+            
+            if hits:
+                return " | ".join(hit["document"] for hit in hits)
+            else:
+                return "No specific medical information found for these symptoms."
+                
+        except Exception as e:
+            st.error(f"Error querying medical knowledge: {str(e)}")
+            return RETRIEVAL_ERROR
+
+class ChromaDBManager(KnowledgeIndex):
     """Manage ChromaDB for medical knowledge storage and retrieval"""
     
-    def __init__(self):
+    backend_name = "ChromaDB"
+    
+    def __init__(self, allow_layout_change: bool = False):
         try:
-            # Initialize ChromaDB client
-            self.client = chromadb.PersistentClient(path="./chroma_db")
+            # Shared per process: embedded store in dev, HTTP client to a Chroma server in production
+            self.client = get_chroma_client()
+            self.embedding_function = get_embedding_function()
             
-            # Get or create collection for medical knowledge
-            self.collection = self.client.get_or_create_collection(
-                name="medical_knowledge",
-                metadata={"hnsw:space": "cosine"}
-            )
+            # After MEDIASSIST_CHROMA_SHARD_BY_CATEGORY is switched, the documents are still
+            # in the other layout and would be ignored (and the built-in set re-seeded).
+            # Only `manage.py rebuild-index` opens such a store, to move them over.
+            other_layout = self._other_layout_names()
+            if other_layout and not allow_layout_change:
+                raise RuntimeError(
+                    f"the knowledge base is stored in the other sharding layout ({', '.join(other_layout)}); "
+                    f"run `python manage.py rebuild-index` to switch it")
             
-            # Initialize with medical knowledge if empty
-            if self.collection.count() == 0:
-                self._initialize_medical_knowledge()
+            # Get or create collection(s) for medical knowledge - one per category when sharded
+            self.collections = self._open_collections()
+            self.collection = None if CHROMA_SHARD_BY_CATEGORY else self.collections[0]
+            
+            # Initialize with medical knowledge if empty. Many workers may start at
+            # once, so check again under the seed lock; seeding itself is an idempotent upsert.
+            if not other_layout and self._document_count() == 0:
+                with self._seed_lock():
+                    if self._document_count() == 0:
+                        self._initialize_medical_knowledge()
                 
         except Exception as e:
             st.error(f"Error initializing ChromaDB: {str(e)}")
             self.client = None
             self.collection = None
+            self.collections = []
+
+    @property
+    def is_available(self) -> bool:
+        return bool(self.collections)
+
+    def _document_count(self) -> int:
+        return sum(collection.count() for collection in self._open_collections())
+
+    @contextmanager
+    def _seed_lock(self):
+        """Serialise seeding across worker processes that share an embedded store.
+
+        In HTTP mode the server serialises writes and the upsert makes repeated
+        seeding harmless, so no lock is taken.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None  # Not available on Windows
+        
+        if CHROMA_MODE == "http" or fcntl is None:
+            yield
+            return
+        
+        os.makedirs(CHROMA_PATH, exist_ok=True)
+        with open(os.path.join(CHROMA_PATH, ".seed.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _collection_metadata(self) -> Dict[str, Any]:
+        """HNSW settings for new collections; M and construction_ef only apply when a collection is (re)built.
+
+        Chroma ignores this metadata for existing collections, so ``_get_collection``
+        applies search_ef to them on open.
+        """
+        return {
+            "hnsw:space": "cosine",
+            "hnsw:M": HNSW_M,
+            "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+            "hnsw:search_ef": HNSW_SEARCH_EF
+        }
+
+    def _collection_name(self, category: Optional[str] = None) -> str:
+        if CHROMA_SHARD_BY_CATEGORY and category:
+            return f"{COLLECTION_NAME}__{re.sub(r'[^a-zA-Z0-9_-]', '_', category)}"
+        return COLLECTION_NAME
+
+    def _get_collection(self, name: str):
+        try:
+            collection = self.client.get_or_create_collection(
+                name=name,
+                metadata=self._collection_metadata(),
+                embedding_function=self.embedding_function
+            )
+        except Exception:
+            # Another worker created it between our get and create
+            collection = self.client.get_collection(name=name, embedding_function=self.embedding_function)
+        
+        # search_ef is a query-time setting, so a changed value takes effect without a rebuild
+        hnsw = (collection.configuration or {}).get("hnsw") or {}
+        if hnsw.get("ef_search", HNSW_SEARCH_EF) != HNSW_SEARCH_EF:
+            collection.modify(configuration={"hnsw": {"ef_search": HNSW_SEARCH_EF}})
+        return collection
+
+    def _all_collection_names(self) -> List[str]:
+        return [c if isinstance(c, str) else c.name for c in self.client.list_collections()]
+
+    def _knowledge_collection_names(self) -> List[str]:
+        """Names of the unsharded collection and all category shards that exist"""
+        return sorted(n for n in self._all_collection_names()
+                      if n == COLLECTION_NAME or n.startswith(f"{COLLECTION_NAME}__"))
+
+    def _other_layout_names(self) -> List[str]:
+        """Non-empty knowledge collections of the layout MEDIASSIST_CHROMA_SHARD_BY_CATEGORY did not select"""
+        names = [name for name in self._knowledge_collection_names()
+                 if (name == COLLECTION_NAME) == CHROMA_SHARD_BY_CATEGORY]
+        return [name for name in names if self.client.get_collection(name).count()]
+
+    def _open_collections(self) -> List[Any]:
+        if not CHROMA_SHARD_BY_CATEGORY:
+            return [self._get_collection(COLLECTION_NAME)]
+        return [self._get_collection(name) for name in self._knowledge_collection_names() if name != COLLECTION_NAME]
+
+    def _add_documents(self, ids: List[str], documents: List[str], metadatas: List[Dict[str, Any]],
+                       embeddings: Optional[List[Any]] = None, name_prefix: str = ""):
+        """Add documents, routing each one to its category shard when sharding is enabled.
+
+        ``name_prefix`` writes into staging collections instead of the live ones.
+        """
+        groups: Dict[str, List[int]] = {}
+        for i, metadata in enumerate(metadatas):
+            groups.setdefault(self._collection_name(metadata.get("category")), []).append(i)
+        
+        for name, indices in groups.items():
+            batch = {
+                "ids": [ids[i] for i in indices],
+                "documents": [documents[i] for i in indices],
+                "metadatas": [metadatas[i] for i in indices]
+            }
+            if embeddings is not None:
+                batch["embeddings"] = [embeddings[i] for i in indices]
+            self._get_collection(name_prefix + name).upsert(**batch)
+        
+        self.collections = self._open_collections()
+        self.collection = None if CHROMA_SHARD_BY_CATEGORY else self.collections[0]
 
     def _initialize_medical_knowledge(self):
         """Initialize ChromaDB with comprehensive medical knowledge"""
@@ -165,55 +663,866 @@ class ChromaDBManager:
             for doc in medical_documents
         ]
         
-        self.collection.add(
-            documents=texts,
-            metadatas=metadatas,
-            ids=ids
-        )
+        self._add_documents(ids, texts, metadatas)
         
         st.success("✅ Medical knowledge base initialized with ChromaDB")
 
-    def query_medical_knowledge(self, symptoms: str, n_results: int = 5) -> str:
-        """Query ChromaDB for relevant medical information"""
-        if not self.collection:
-            return "Medical knowledge base not available."
+    def _query_batch(self, query_texts: Optional[List[str]] = None, n_results: int = 5,
+                           query_embeddings: Optional[List[List[float]]] = None) -> List[List[Dict[str, Any]]]:
+        """Run a batch of queries against every collection and merge the hits per query by distance.
+
+        Shards are queried in parallel; each query's result list is at most ``n_results`` long.
+        """
+        def query_collection(collection):
+            return collection.query(
+                query_texts=query_texts,
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                include=["documents", "metadatas", "distances"]
+            )
+        
+        def query_all():
+            if len(self.collections) == 1:
+                return [query_collection(self.collections[0])]
+            return list(get_shard_query_executor().map(query_collection, self.collections))
         
         try:
-            # Query ChromaDB for relevant documents
-            results = self.collection.query(
-                query_texts=[symptoms],
-                n_results=n_results
-            )
-            
-            if results['documents'][0]:
-                # Combine retrieved documents
-                relevant_docs = results['documents'][0]
-                return " | ".join(relevant_docs)
-            else:
-                return "No specific medical information found for these symptoms."
-                
+            all_results = query_all()
+        except Exception:
+            # A rebuild (possibly by another worker) replaced the collections; reopen them by name
+            self.collections = self._open_collections()
+            self.collection = None if CHROMA_SHARD_BY_CATEGORY else self.collections[0]
+            all_results = query_all()
+        
+        merged = []
+        for q in range(len(query_texts if query_texts is not None else query_embeddings)):
+            hits = []
+            for results in all_results:
+                for i, doc_id in enumerate(results['ids'][q]):
+                    hits.append({
+                        "id": doc_id,
+                        "document": results['documents'][q][i],
+                        "metadata": results['metadatas'][q][i],
+                        "distance": results['distances'][q][i]
+                    })
+            hits.sort(key=lambda hit: hit["distance"])
+            merged.append(hits[:n_results])
+        return merged
+
+    def read_all_documents(self, batch_size: int = 1000) -> Dict[str, List[Any]]:
+        """Read ids, documents, metadatas and stored embeddings from every knowledge collection"""
+        corpus = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+        for name in self._knowledge_collection_names():
+            collection = self.client.get_collection(name, embedding_function=self.embedding_function)
+            offset = 0
+            while True:
+                page = collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+                if not page['ids']:
+                    break
+                corpus["ids"].extend(page['ids'])
+                corpus["documents"].extend(page['documents'])
+                corpus["metadatas"].extend(page['metadatas'])
+                corpus["embeddings"].extend(list(page['embeddings']))
+                offset += len(page['ids'])
+        return corpus
+
+    def rebuild_index(self, batch_size: int = 1000) -> int:
+        """Rebuild all knowledge collections with the current HNSW and sharding settings.
+
+        Stored embeddings are copied rather than recomputed. The fresh HNSW graph
+        also compacts away entries left behind by deletes and updates. The copy
+        goes into staging collections; live collections are only swapped out
+        and deleted once it is complete, so queries keep working meanwhile and
+        a failed rebuild leaves the index untouched.
+        """
+        # Staging collections left behind by an interrupted rebuild
+        for name in self._all_collection_names():
+            if name.startswith("rebuild-"):
+                self.client.delete_collection(name)
+        
+        corpus = self.read_all_documents(batch_size)
+        old_names = self._knowledge_collection_names()
+        staging_prefix = f"rebuild-{uuid.uuid4().hex[:8]}-"
+        
+        for start in range(0, len(corpus["ids"]), batch_size):
+            end = start + batch_size
+            self._add_documents(corpus["ids"][start:end], corpus["documents"][start:end],
+                                corpus["metadatas"][start:end], corpus["embeddings"][start:end],
+                                name_prefix=staging_prefix)
+        
+        # Swap: retire the live collection, promote the staged copy, then drop the old one
+        new_names = [name[len(staging_prefix):] for name in self._all_collection_names() if name.startswith(staging_prefix)]
+        retired = []
+        for name in new_names:
+            if name in old_names:
+                retired_name = f"retired-{staging_prefix[len('rebuild-'):]}{name}"
+                self.client.get_collection(name).modify(name=retired_name)
+                retired.append(retired_name)
+            self.client.get_collection(staging_prefix + name).modify(name=name)
+        for name in retired + [name for name in old_names if name not in new_names]:
+            self.client.delete_collection(name)
+        
+        self.collections = self._open_collections()
+        self.collection = None if CHROMA_SHARD_BY_CATEGORY else self.collections[0]
+        return len(corpus["ids"])
+
+    def measure_recall(self, queries: List[str], k: int = 3) -> Dict[str, float]:
+        """Compare approximate (HNSW) top-k against exact cosine search for a held-out query set"""
+        import numpy as np
+        
+        corpus = self.read_all_documents()
+        matrix = np.asarray(corpus["embeddings"], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        
+        query_embeddings = [list(map(float, e)) for e in self.embedding_function(queries)]
+        query_matrix = np.asarray(query_embeddings, dtype=np.float32)
+        query_matrix /= np.linalg.norm(query_matrix, axis=1, keepdims=True)
+        
+        k = min(k, len(corpus["ids"]))
+        exact_scores = query_matrix @ matrix.T
+        exact = [{corpus["ids"][j] for j in np.argsort(-row)[:k]} for row in exact_scores]
+        
+        start = time.perf_counter()
+        approximate = self._query_batch(query_embeddings=query_embeddings, n_results=k)
+        elapsed = time.perf_counter() - start
+        
+        recalls = [len(exact[i] & {hit["id"] for hit in approximate[i]}) / k for i in range(len(queries))]
+        return {
+            "recall": sum(recalls) / len(recalls),
+            "k": k,
+            "queries": len(queries),
+            "documents": len(corpus["ids"]),
+            "ann_latency_ms": elapsed / len(queries) * 1000
+        }
+
+def _chroma_manager_usable(manager: ChromaDBManager) -> bool:
+    """Cache validation: reconnect an unavailable manager only when the chroma breaker allows a call.
+
+    While the breaker is open the failed manager stays cached, so reruns fall
+    back to the keyword context without paying for another connect attempt.
+    """
+    return manager.is_available or not get_circuit_breakers()["chroma"].allow()
+
+@st.cache_resource(validate=_chroma_manager_usable)
+def get_chroma_manager() -> ChromaDBManager:
+    """Open (and if needed seed) the knowledge collections once per process"""
+    manager = ChromaDBManager()
+    breaker = get_circuit_breakers()["chroma"]
+    if manager.is_available:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+    return manager
+
+class NumpyVectorIndex(KnowledgeIndex):
+    """In-process brute-force cosine search over a memory-mapped embedding snapshot.
+
+    The snapshot (``embeddings.npy`` with L2-normalised float32 rows plus
+    ``metadata.json``) is written by ``python manage.py export-vector-snapshot``.
+    Mapping it read-only lets every worker share the same page-cache pages and
+    start without building an index; top-k is a single matmul plus argpartition.
+    """
+    
+    backend_name = "NumPy snapshot"
+    EMBEDDINGS_FILE = "embeddings.npy"
+    METADATA_FILE = "metadata.json"
+
+    def __init__(self, snapshot_dir: str = VECTOR_SNAPSHOT_DIR):
+        import numpy as np
+        
+        try:
+            self.matrix = np.load(os.path.join(snapshot_dir, self.EMBEDDINGS_FILE), mmap_mode="r")
+            with open(os.path.join(snapshot_dir, self.METADATA_FILE), encoding="utf-8") as f:
+                metadata = json.load(f)
+            self.ids = metadata["ids"]
+            self.documents = metadata["documents"]
+            self.metadatas = metadata["metadatas"]
+            self.embedding_function = get_embedding_function()
         except Exception as e:
-            st.error(f"Error querying medical knowledge: {str(e)}")
-            return "Error retrieving medical information."
+            st.error(f"Error loading vector snapshot: {str(e)}")
+            self.matrix = None
+            self.ids = []
+
+    @property
+    def is_available(self) -> bool:
+        return self.matrix is not None and len(self.ids) > 0
+
+    def _query_batch(self, query_texts: Optional[List[str]] = None, n_results: int = 5,
+                     query_embeddings: Optional[List[List[float]]] = None) -> List[List[Dict[str, Any]]]:
+        import numpy as np
+        
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        
+        # (n_queries, n_documents) cosine similarities in one matmul
+        scores = queries @ self.matrix.T
+        k = min(n_results, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        
+        merged = []
+        for row, candidates in enumerate(top):
+            ordered = candidates[np.argsort(-scores[row, candidates])]
+            merged.append([
+                {
+                    "id": self.ids[j],
+                    "document": self.documents[j],
+                    "metadata": self.metadatas[j],
+                    "distance": float(1.0 - scores[row, j])  # Cosine distance, as reported by Chroma
+                }
+                for j in ordered
+            ])
+        return merged
+
+    @classmethod
+    def export_snapshot(cls, manager: ChromaDBManager, snapshot_dir: str = VECTOR_SNAPSHOT_DIR) -> int:
+        """Write a snapshot of every Chroma knowledge collection; files are replaced atomically"""
+        import numpy as np
+        
+        corpus = manager.read_all_documents()
+        matrix = np.asarray(corpus["embeddings"], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        
+        os.makedirs(snapshot_dir, exist_ok=True)
+        embeddings_path = os.path.join(snapshot_dir, cls.EMBEDDINGS_FILE)
+        metadata_path = os.path.join(snapshot_dir, cls.METADATA_FILE)
+        
+        np.save(embeddings_path + ".tmp.npy", np.ascontiguousarray(matrix))
+        with open(metadata_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"ids": corpus["ids"], "documents": corpus["documents"], "metadatas": corpus["metadatas"]}, f)
+        os.replace(embeddings_path + ".tmp.npy", embeddings_path)
+        os.replace(metadata_path + ".tmp", metadata_path)
+        return len(corpus["ids"])
+
+@st.cache_resource
+def get_numpy_vector_index() -> NumpyVectorIndex:
+    """Map the vector snapshot once per process"""
+    return NumpyVectorIndex(VECTOR_SNAPSHOT_DIR)
+
+@st.cache_resource
+def start_knowledge_warmup() -> threading.Event:
+    """Open the knowledge index and load the embedding model in the background, once per process.
+
+    The returned event is the readiness signal: it is set, and READY_FILE written,
+    only after a warm-up query succeeded in this (the serving) process. A failed
+    warm-up leaves the process not ready; the first retrieval then tries again.
+    """
+    ready = threading.Event()
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)  # Left over from an earlier process
+    
+    def run():
+        if DEPENDENCIES_AVAILABLE and VECTOR_BACKEND != "none":
+            try:
+                index = get_numpy_vector_index() if VECTOR_BACKEND == "numpy" else get_chroma_manager()
+                if not index.is_available:
+                    return
+                index._query_batch(["warm-up"], 1)
+            except Exception:
+                return
+        ready.set()
+        if READY_FILE:
+            with open(READY_FILE, "w") as f:
+                f.write(datetime.now(timezone.utc).isoformat())
+    
+    threading.Thread(target=run, name="mediassist-knowledge-warmup", daemon=True).start()
+    return ready
+
+class StorageBackend(ABC):
+    """Interface for persisting assessments and reading them back"""
+    
+    # Shown to the user when a save fails
+    setup_hint = "Check your database configuration."
+
+    @abstractmethod
+    def save_session(self, record: Dict[str, Any]) -> Dict[str, str]:
+        """Upsert the patient and store one session; returns its patient_id and session_id"""
+
+    @abstractmethod
+    def bulk_insert(self, records: List[Dict[str, Any]]) -> int:
+        """Store many session records in one batch; returns the number stored"""
+
+    @abstractmethod
+    def get_history(self, patient_id: str, cursor: Optional[Dict[str, str]] = None,
+                    page_size: int = 10) -> tuple:
+        """Get one page of a patient's sessions (newest first) using keyset pagination.
+
+        Returns ``(rows, next_cursor)``; ``next_cursor`` is None on the last page.
+        """
+
+    @abstractmethod
+    def get_analytics(self, days: int = 30) -> Dict[str, List[Dict[str, Any]]]:
+        """Get sessions per day, top conditions and severity distribution"""
+
+    @abstractmethod
+    def _fetch_sessions_page(self, since: Optional[str], until: Optional[str],
+                             cursor: Optional[Dict[str, str]], page_size: int) -> List[Dict[str, Any]]:
+        """Fetch sessions after ``cursor`` in (created_at, id) order, joined with their patient"""
+
+    def iter_sessions(self, since: Optional[str] = None, until: Optional[str] = None,
+                      page_size: int = 1000):
+        """Yield every session in [since, until) oldest first, one keyset page in memory at a time"""
+        cursor = None
+        while True:
+            rows = self._fetch_sessions_page(since, until, cursor, page_size)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            cursor = {'created_at': rows[-1]['created_at'], 'id': rows[-1]['id']}
+
+    @staticmethod
+    def _paginate(rows: List[Dict[str, Any]], page_size: int) -> tuple:
+        """Split a page fetched with one extra row into (rows, next_cursor)"""
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            return rows, {'created_at': rows[-1]['created_at'], 'id': rows[-1]['id']}
+        return rows, None
+
+class SupabaseStorage(StorageBackend):
+    """Supabase (Postgres) storage using the RPCs from ``database_setup_sql``"""
+    
+    setup_hint = "This might be due to RLS policies or missing database setup (including the save_symptom_session function). Check your Supabase configuration."
+
+    def __init__(self, url: str, key: str):
+        from supabase import ClientOptions, create_client
+        
+        # Bounded HTTP timeout so a degraded database fails fast instead of stalling the session
+        self.client = create_client(url, key, options=ClientOptions(postgrest_client_timeout=STORAGE_TIMEOUT_SECONDS))
+
+    def save_session(self, record: Dict[str, Any]) -> Dict[str, str]:
+        params = {f"p_{field}": value for field, value in record.items()}
+        result = self.client.rpc('save_symptom_session', params).execute()
+        if not result.data:
+            raise RuntimeError("Failed to save assessment data")
+        return result.data
+
+    def bulk_insert(self, records: List[Dict[str, Any]]) -> int:
+        if not records:
+            return 0
+        return self.client.rpc('save_symptom_sessions_bulk', {'p_records': records}).execute().data or 0
+
+    def get_history(self, patient_id: str, cursor: Optional[Dict[str, str]] = None,
+                    page_size: int = 10) -> tuple:
+        params = {
+            'p_patient_id': patient_id,
+            'p_before_created_at': cursor['created_at'] if cursor else None,
+            'p_before_id': cursor['id'] if cursor else None,
+            'p_limit': page_size + 1  # One extra row tells us whether there is a next page
+        }
+        rows = self.client.rpc('patient_session_history', params).execute().data or []
+        return self._paginate(rows, page_size)
+
+    def get_analytics(self, days: int = 30) -> Dict[str, List[Dict[str, Any]]]:
+        return {
+            'sessions_per_day': self.client.rpc('sessions_per_day', {'p_days': days}).execute().data or [],
+            'top_conditions': self.client.rpc('top_conditions', {'p_days': days, 'p_limit': 10}).execute().data or [],
+            'severity_distribution': self.client.rpc('severity_distribution', {'p_days': days}).execute().data or []
+        }
+
+    def _fetch_sessions_page(self, since: Optional[str], until: Optional[str],
+                             cursor: Optional[Dict[str, str]], page_size: int) -> List[Dict[str, Any]]:
+        query = self.client.table('symptom_sessions').select(
+            'id, patient_id, session_id, created_at, answers, diagnosis, treatment, medications, home_remedies, '
+            'patient:patients(name, age, gender, weight, height)'
+        )
+        if since:
+            query = query.gte('created_at', since)
+        if until:
+            query = query.lt('created_at', until)
+        if cursor:
+            created_at = cursor['created_at']
+            query = query.or_(f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{cursor["id"]})')
+        return query.order('created_at').order('id').limit(page_size).execute().data or []
+
+class SQLiteStorage(StorageBackend):
+    """Local SQLite storage mirroring the Supabase ``patients``/``symptom_sessions`` schema.
+
+    Runs in WAL mode with one connection per thread, so reads run concurrently
+    and never wait for the writer; only writes are serialised by a lock.
+    Statements are fixed parameterised SQL, so each connection's statement
+    cache reuses the prepared plans, and ``bulk_insert`` writes a whole batch
+    in one transaction.
+    """
+    
+    setup_hint = "Check that the SQLite database path is writable."
+    
+    SCHEMA = """
+    create table if not exists patients (
+      id text primary key,
+      patient_key text unique,
+      name text not null,
+      date_of_birth text,
+      age integer not null,
+      gender text not null,
+      weight real,
+      height real,
+      created_at text not null
+    );
+    create table if not exists symptom_sessions (
+      id text primary key,
+      patient_id text references patients(id) on delete cascade,
+      answers text not null,
+      diagnosis text,
+      treatment text,
+      medications text,
+      home_remedies text,
+      session_id text,
+      created_at text not null
+    );
+    create index if not exists patients_created_at_idx on patients(created_at);
+    create index if not exists symptom_sessions_created_at_idx on symptom_sessions(created_at, id);
+    create index if not exists symptom_sessions_patient_history_idx on symptom_sessions(patient_id, created_at desc, id desc);
+    """
+    
+    UPSERT_PATIENT_SQL = """
+    insert into patients (id, patient_key, name, date_of_birth, age, gender, weight, height, created_at)
+    values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    on conflict (patient_key) do update
+      set name = excluded.name,
+          date_of_birth = coalesce(excluded.date_of_birth, patients.date_of_birth),
+          age = excluded.age,
+          weight = coalesce(excluded.weight, patients.weight),
+          height = coalesce(excluded.height, patients.height)
+    """
+    
+    INSERT_SESSION_SQL = """
+    insert into symptom_sessions (id, patient_id, answers, diagnosis, treatment, medications, home_remedies, session_id, created_at)
+    values (?, (select id from patients where patient_key = ?), ?, ?, ?, ?, ?, ?, ?)
+    """
+    
+    HISTORY_SQL = """
+    select id, created_at, json_extract(answers, '$.main_symptom') as main_symptom,
+           json_extract(answers, '$.symptom_severity') as symptom_severity, diagnosis, treatment
+    from symptom_sessions
+    where patient_id = ? and (? is null or (created_at, id) < (?, ?))
+    order by created_at desc, id desc
+    limit ?
+    """
+
+    EXPORT_SQL = """
+    select s.id, s.patient_id, s.session_id, s.created_at, s.answers, s.diagnosis, s.treatment,
+           s.medications, s.home_remedies, p.name, p.age, p.gender, p.weight, p.height
+    from symptom_sessions s
+    left join patients p on p.id = s.patient_id
+    where (? is null or s.created_at >= ?)
+      and (? is null or s.created_at < ?)
+      and (? is null or (s.created_at, s.id) > (?, ?))
+    order by s.created_at, s.id
+    limit ?
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Streamlit sessions and worker pools run on separate threads; each gets its own connection
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        
+        conn = self._connection()
+        conn.execute("pragma journal_mode = wal")  # Persistent on the database file
+        with self._write_lock:
+            conn.executescript(self.SCHEMA)
+            # Databases created before patients had a date of birth
+            if 'date_of_birth' not in {row['name'] for row in conn.execute("pragma table_info(patients)")}:
+                conn.execute("alter table patients add column date_of_birth text")
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection, opened on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma synchronous = normal")
+            conn.execute("pragma foreign_keys = on")
+            conn.execute("pragma busy_timeout = 5000")
+            self._local.conn = conn
+        return conn
+
+    def _patient_params(self, record: Dict[str, Any]) -> tuple:
+        return (str(uuid.uuid4()), record['patient_key'], record['name'], record.get('date_of_birth'), record['age'],
+                record['gender'],
+                record['weight'], record['height'], record['created_at'])
+
+    def _session_params(self, record: Dict[str, Any], session_row_id: str) -> tuple:
+        return (session_row_id, record['patient_key'], json.dumps(record['answers']), json.dumps(record['diagnosis']),
+                json.dumps(record['treatment']), json.dumps(record['medications']),
+                json.dumps(record['home_remedies']), record['session_id'], record['created_at'])
+
+    def save_session(self, record: Dict[str, Any]) -> Dict[str, str]:
+        session_row_id = str(uuid.uuid4())
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute(self.UPSERT_PATIENT_SQL, self._patient_params(record))
+            conn.execute(self.INSERT_SESSION_SQL, self._session_params(record, session_row_id))
+            patient_id = conn.execute("select id from patients where patient_key = ?", (record['patient_key'],)).fetchone()['id']
+        return {'patient_id': patient_id, 'session_id': session_row_id}
+
+    def bulk_insert(self, records: List[Dict[str, Any]]) -> int:
+        if not records:
+            return 0
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.executemany(self.UPSERT_PATIENT_SQL, [self._patient_params(r) for r in records])
+            conn.executemany(self.INSERT_SESSION_SQL, [self._session_params(r, str(uuid.uuid4())) for r in records])
+        return len(records)
+
+    def get_history(self, patient_id: str, cursor: Optional[Dict[str, str]] = None,
+                    page_size: int = 10) -> tuple:
+        before_created_at = cursor['created_at'] if cursor else None
+        before_id = cursor['id'] if cursor else None
+        rows = self._connection().execute(self.HISTORY_SQL, (patient_id, before_created_at, before_created_at,
+                                                             before_id, page_size + 1)).fetchall()
+        rows = [
+            {**dict(row), 'diagnosis': json.loads(row['diagnosis'] or '[]'), 'treatment': json.loads(row['treatment'] or '[]')}
+            for row in rows
+        ]
+        return self._paginate(rows, page_size)
+
+    def get_analytics(self, days: int = 30) -> Dict[str, List[Dict[str, Any]]]:
+        since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        conn = self._connection()
+        per_day = conn.execute(
+            "select substr(created_at, 1, 10) as day, count(*) as sessions from symptom_sessions "
+            "where created_at >= ? group by day order by day", (since,)).fetchall()
+        conditions = conn.execute(
+            "select json_extract(diagnosis, '$[0].condition') as condition, count(*) as sessions from symptom_sessions "
+            "where created_at >= ? and condition is not null group by condition order by sessions desc limit 10", (since,)).fetchall()
+        severity = conn.execute(
+            "select cast(json_extract(answers, '$.symptom_severity') as integer) as severity, count(*) as sessions "
+            "from symptom_sessions where created_at >= ? and severity > 0 group by severity order by severity", (since,)).fetchall()
+        return {
+            'sessions_per_day': [dict(row) for row in per_day],
+            'top_conditions': [dict(row) for row in conditions],
+            'severity_distribution': [dict(row) for row in severity]
+        }
+
+    def session_count(self) -> int:
+        return self._connection().execute("select count(*) from symptom_sessions").fetchone()[0]
+
+    def fetch_records(self, limit: int = 500) -> List[tuple]:
+        """Read the oldest sessions back as ``(session_row_id, record)`` pairs in ``build_session_record`` form"""
+        rows = self._connection().execute(
+            "select s.id, s.answers, s.diagnosis, s.treatment, s.medications, s.home_remedies, s.session_id, "
+            "s.created_at, p.patient_key, p.name, p.date_of_birth, p.age, p.gender, p.weight, p.height "
+            "from symptom_sessions s join patients p on p.id = s.patient_id "
+            "order by s.created_at, s.id limit ?", (limit,)).fetchall()
+        
+        json_columns = ('answers', 'diagnosis', 'treatment', 'medications', 'home_remedies')
+        records = []
+        for row in rows:
+            record = {key: row[key] for key in ('patient_key', 'name', 'date_of_birth', 'age', 'gender', 'weight',
+                                                'height', 'session_id', 'created_at')}
+            record.update({key: json.loads(row[key]) if row[key] else None for key in json_columns})
+            records.append((row['id'], record))
+        return records
+
+    def delete_sessions(self, session_row_ids: List[str]) -> int:
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.executemany("delete from symptom_sessions where id = ?", [(i,) for i in session_row_ids])
+        return len(session_row_ids)
+
+    def _fetch_sessions_page(self, since: Optional[str], until: Optional[str],
+                             cursor: Optional[Dict[str, str]], page_size: int) -> List[Dict[str, Any]]:
+        after_created_at = cursor['created_at'] if cursor else None
+        after_id = cursor['id'] if cursor else None
+        rows = self._connection().execute(self.EXPORT_SQL, (since, since, until, until, after_created_at,
+                                                            after_created_at, after_id, page_size)).fetchall()
+        
+        json_columns = ('answers', 'diagnosis', 'treatment', 'medications', 'home_remedies')
+        sessions = []
+        for row in rows:
+            session = {key: row[key] for key in ('id', 'patient_id', 'session_id', 'created_at')}
+            session.update({key: json.loads(row[key]) if row[key] else None for key in json_columns})
+            session['patient'] = {key: row[key] for key in ('name', 'age', 'gender', 'weight', 'height')}
+            sessions.append(session)
+        return sessions
+
+# Flat column layout shared by the CSV, JSONL and Parquet exports
+EXPORT_TOP_DIAGNOSES = 3
+EXPORT_COLUMNS = (
+    ['id', 'patient_id', 'session_id', 'created_at',
+     'patient_name', 'patient_age', 'patient_gender', 'patient_weight', 'patient_height']
+    + [f"answer_{field}" for field in PatientData.__dataclass_fields__]
+    + [f"diagnosis_{i}_{part}" for i in range(1, EXPORT_TOP_DIAGNOSES + 1) for part in ("condition", "probability")]
+    + ['diagnosis_conditions', 'treatment', 'medications', 'home_remedies']
+)
+
+def _json_list(value: Any) -> List[Any]:
+    """jsonb columns may hold a list, a JSON-encoded string (older rows) or null"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value if isinstance(value, list) else []
+
+def flatten_session(session: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten a session row (with its answers/diagnosis jsonb) into EXPORT_COLUMNS"""
+    patient = session.get('patient') or {}
+    answers = session.get('answers') or {}
+    diagnoses = _json_list(session.get('diagnosis'))
+    
+    row = {
+        'id': session.get('id'),
+        'patient_id': session.get('patient_id'),
+        'session_id': session.get('session_id'),
+        'created_at': session.get('created_at'),
+        'patient_name': patient.get('name'),
+        'patient_age': patient.get('age'),
+        'patient_gender': patient.get('gender'),
+        'patient_weight': patient.get('weight'),
+        'patient_height': patient.get('height')
+    }
+    for field in PatientData.__dataclass_fields__:
+        row[f"answer_{field}"] = answers.get(field)
+    for i in range(EXPORT_TOP_DIAGNOSES):
+        diag = diagnoses[i] if i < len(diagnoses) and isinstance(diagnoses[i], dict) else {}
+        row[f"diagnosis_{i + 1}_condition"] = diag.get('condition')
+        row[f"diagnosis_{i + 1}_probability"] = diag.get('probability')
+    row['diagnosis_conditions'] = "; ".join(d.get('condition', '') for d in diagnoses if isinstance(d, dict))
+    row['treatment'] = "; ".join(str(t) for t in _json_list(session.get('treatment')))
+    row['medications'] = "; ".join(m.get('name', '') for m in _json_list(session.get('medications')) if isinstance(m, dict))
+    row['home_remedies'] = "; ".join(r.get('remedy', '') for r in _json_list(session.get('home_remedies')) if isinstance(r, dict))
+    return row
+
+def write_sessions_export(storage: StorageBackend, path: str, fmt: str, since: Optional[str] = None,
+                          until: Optional[str] = None, page_size: int = 1000, row_group_size: int = 50000) -> int:
+    """Stream sessions to a CSV, JSONL or Parquet file with constant memory; returns the row count.
+
+    Rows are read one keyset page at a time and written straight out; Parquet
+    buffers at most ``row_group_size`` rows before writing a row group.
+    """
+    rows = (flatten_session(session) for session in storage.iter_sessions(since, until, page_size))
+    count = 0
+    
+    if fmt == "csv":
+        import csv
+        
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    
+    elif fmt == "jsonl":
+        with open(path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, default=str) + "\n")
+                count += 1
+    
+    elif fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        numeric_types = {'patient_age': pa.int64(), 'answer_age': pa.int64(), 'patient_weight': pa.float64(),
+                         'patient_height': pa.float64(), 'answer_weight': pa.float64(), 'answer_height': pa.float64()}
+        schema = pa.schema([(column, numeric_types.get(column, pa.string())) for column in EXPORT_COLUMNS])
+        
+        with pq.ParquetWriter(path, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append({column: (value if column in numeric_types or value is None else str(value))
+                              for column, value in row.items()})
+                if len(batch) >= row_group_size:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+    
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    
+    return count
+
+@st.cache_resource
+def get_storage_backend() -> Optional[StorageBackend]:
+    """Create the configured storage backend once per process"""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    if not DEPENDENCIES_AVAILABLE:
+        return None
+    return SupabaseStorage(SUPABASE_URL, SUPABASE_KEY)
+
+@st.cache_resource
+def get_spool_storage() -> Optional[SQLiteStorage]:
+    """Local fallback for saves while the primary storage is down (not needed when it is SQLite already)"""
+    if STORAGE_BACKEND == "sqlite" or not SPOOL_PATH:
+        return None
+    return SQLiteStorage(SPOOL_PATH)
+
+def _terms_regex(terms: List[str]):
+    """Compile alternative regex fragments into one case-insensitive whole-word pattern"""
+    return re.compile(r"\b(?:" + "|".join(terms) + r")\b", re.IGNORECASE)
+
+class SafetyRuleEngine:
+    """Local, deterministic safety screening compiled once from ``safety_rules.json``.
+
+    ``screen_patient`` matches the symptom answers against red-flag patterns, so
+    emergencies are caught without waiting for (or trusting) the LLM. A match is
+    only ignored when a cue is attached to it: a negation directly before it
+    ("no chest pain", "denies any chest pain") or a history marker directly before
+    or after it ("history of seizures", "seizures in the past"). Flags with
+    ``always_screen`` ignore cues altogether.
+    ``filter_medications`` checks suggested medications against the patient's
+    allergies, current medications and each other, removing unsafe ones and
+    returning a warning for every finding.
+    """
+    
+    def __init__(self, rules: Dict[str, Any]):
+        self.symptom_fields = rules['symptom_fields']
+        self.emergency_guidance = rules['emergency_guidance']
+        # Cues ending right before a match (an article or "any" may sit in between) or starting right after it
+        self.cues_before = re.compile(
+            r"\b(?:" + "|".join(rules.get('negations', []) + rules.get('history_before', []) or [r"(?!)"])
+            + r")\s+(?:(?:any|a|an|the)\s+)?$", re.IGNORECASE)
+        self.cues_after = re.compile(r"\s*(?:" + "|".join(rules.get('history_after', []) or [r"(?!)"]) + r")\b",
+                                     re.IGNORECASE)
+        self.red_flags = [
+            {
+                'id': flag['id'],
+                'label': flag['label'],
+                'pattern': _terms_regex(flag['patterns']),
+                'requires': [re.compile(term, re.IGNORECASE) for term in flag.get('requires', [])],
+                'min_severity': flag.get('min_severity', 0),
+                'always_screen': flag.get('always_screen', False),
+            }
+            for flag in rules['red_flags']
+        ]
+        self.drug_classes = {name: _terms_regex(terms) for name, terms in rules['drug_classes'].items()}
+        self.allergies = [(_terms_regex(rule['allergy']), set(rule['avoid'])) for rule in rules['allergies']]
+        self.non_drug_words = {word.lower() for word in rules.get('non_drug_words', [])}
+        self.interactions = [(tuple(rule['classes']), rule['action'], rule['reason']) for rule in rules['interactions']]
+
+    @classmethod
+    def from_file(cls, path: str) -> "SafetyRuleEngine":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    @staticmethod
+    def _severity(patient_data: PatientData) -> int:
+        match = re.match(r"\s*(\d+)", str(patient_data.symptom_severity))
+        return int(match.group(1)) if match else 0
+
+    def _asserted(self, pattern, text: str, always: bool = False) -> bool:
+        """True when ``pattern`` matches somewhere without an attached negation or history cue"""
+        if always:
+            return bool(pattern.search(text))
+        for match in pattern.finditer(text):
+            if self.cues_before.search(text, 0, match.start()) or self.cues_after.match(text, match.end()):
+                continue
+            return True
+        return False
+
+    def screen_patient(self, patient_data: PatientData) -> List[Dict[str, str]]:
+        """Return the red flags (id and label) matched by the patient's symptom answers"""
+        text = " | ".join(str(getattr(patient_data, field)) for field in self.symptom_fields)
+        severity = self._severity(patient_data)
+        matches = []
+        for flag in self.red_flags:
+            if severity < flag['min_severity']:
+                continue
+            patterns = [flag['pattern']] + flag['requires']
+            if all(self._asserted(pattern, text, flag['always_screen']) for pattern in patterns):
+                matches.append({'id': flag['id'], 'label': flag['label']})
+        return matches
+
+    def emergency_assessment(self, patient_data: PatientData, matches: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Assessment returned instead of the LLM's when a red flag matches"""
+        return {
+            "collected_data": asdict(patient_data),
+            "emergency": True,
+            "emergency_guidance": self.emergency_guidance,
+            "possible_diagnosis": [],
+            "prescribed_medications": [],
+            "home_remedies": [],
+            "treatment_recommendations": [self.emergency_guidance],
+            "red_flags": [match['label'] for match in matches],
+            "lifestyle_recommendations": [],
+            "follow_up_care": ["Follow the advice of the emergency team, then see your regular doctor"],
+            "safety_warnings": [f"Emergency warning sign: {match['label']}" for match in matches],
+            "disclaimer": "This is not a medical diagnosis. Warning signs were detected in your answers - seek emergency care now."
+        }
+
+    def classes_in(self, text: str) -> set:
+        """Drug classes mentioned in free text (a medication name or a list of them)"""
+        return {name for name, pattern in self.drug_classes.items() if pattern.search(text or "")}
+
+    def _interactions(self, classes: set, other_classes: set, source: str) -> List[tuple]:
+        """``(action, message)`` for every interaction between ``classes`` and ``other_classes``"""
+        return [
+            (action, f"interacts with {source} - {reason}")
+            for (a, b), action, reason in self.interactions
+            if (a in classes and b in other_classes) or (b in classes and a in other_classes)
+        ]
+
+    def filter_medications(self, patient_data: PatientData,
+                           medications: List[Dict[str, Any]]) -> tuple:
+        """Check medications against allergies, current medications and each other.
+
+        Returns ``(kept_medications, warnings)``.
+        """
+        allergies = str(patient_data.allergies)
+        if PLACEHOLDER_ANSWER.match(allergies):
+            allergies = ""
+        avoided_classes = set().union(*(avoid for pattern, avoid in self.allergies if pattern.search(allergies)))
+        current_classes = self.classes_in(str(patient_data.current_medications))
+        
+        kept, kept_classes, warnings = [], set(), []
+        for medication in medications:
+            name = str(medication.get('name', ''))
+            classes = self.classes_in(name)
+            # Words of the name that could be a drug (not doses, forms or words like "relief")
+            drug_words = [word for word in re.findall(r"[a-zA-Z][a-zA-Z-]{3,}", name)
+                          if word.lower() not in self.non_drug_words]
+            named = next((word for word in drug_words
+                          if re.search(rf"\b{re.escape(word)}\b", allergies, re.IGNORECASE)), "")
+            
+            allergic = classes & avoided_classes
+            if allergic or named:
+                warnings.append(f"Removed {name}: reported allergy ({', '.join(sorted(allergic)) or named.lower()})")
+                continue
+            
+            findings = (self._interactions(classes, current_classes, "current medications")
+                        + self._interactions(classes, kept_classes, "other suggested medications"))
+            removals = [message for action, message in findings if action == "remove"]
+            if removals:
+                warnings.append(f"Removed {name}: {removals[0]}")
+                continue
+            warnings.extend(f"Caution with {name}: {message}" for _, message in findings)
+            
+            kept.append(medication)
+            kept_classes |= classes
+        return kept, warnings
+
+    def apply(self, patient_data: PatientData, diagnosis_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Post-filter an assessment's medications and attach the safety warnings"""
+        medications, warnings = self.filter_medications(patient_data, diagnosis_result.get('prescribed_medications') or [])
+        return {**diagnosis_result, 'prescribed_medications': medications,
+                'safety_warnings': diagnosis_result.get('safety_warnings', []) + warnings}
+
+@st.cache_resource
+def get_safety_engine() -> SafetyRuleEngine:
+    """Compile the safety rules once per process"""
+    return SafetyRuleEngine.from_file(SAFETY_RULES_PATH)
 
 class MediAssistChatbot:
     def __init__(self):
-        if DEPENDENCIES_AVAILABLE:
-            try:
-                self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-                self.chroma_manager = ChromaDBManager()
-            except Exception as e:
-                st.error(f"Failed to connect to databases: {str(e)}")
-                self.supabase = None
-                self.chroma_manager = None
-        else:
-            self.supabase = None
-            self.chroma_manager = None
+        # Storage and the knowledge index are opened at first use (see the properties
+        # below), so rendering the questionnaire never imports supabase or chromadb
+        self._storage = None
+        self._chroma_manager = None
+        
+        try:
+            self.safety = get_safety_engine()
+        except Exception as e:
+            st.error(f"Failed to load safety rules: {str(e)}")
+            self.safety = None
         
         # Enhanced medical questions for better context
         self.questions = [
             {"key": "name", "question": "What's your full name?", "type": "text", "required": True},
-            {"key": "age", "question": "What's your age?", "type": "number", "required": True},
+            {"key": "date_of_birth", "question": "What's your date of birth?", "type": "date", "required": True},
             {"key": "gender", "question": "What's your gender?", "type": "select", 
              "options": ["Male", "Female", "Other", "Prefer not to say"], "required": True},
             {"key": "weight", "question": "What's your weight (in kg)?", "type": "number", "required": False},
@@ -251,6 +1560,17 @@ class MediAssistChatbot:
             {"key": "dietary_habits", "question": "Any recent changes in diet, appetite, or eating patterns?", 
              "type": "text_area", "required": False}
         ]
+        
+        # Question pages for grouped mode - each page is submitted as a single form
+        self.question_pages = [
+            {"title": "👤 About You", "keys": ["name", "date_of_birth", "gender", "weight", "height"]},
+            {"title": "🩺 Your Symptoms", "keys": ["main_symptom", "additional_symptoms", "symptom_duration",
+                                                 "symptom_severity", "pain_location", "symptom_triggers"]},
+            {"title": "📋 Medical History", "keys": ["medical_history", "current_medications", "allergies", "family_history"]},
+            {"title": "🌱 Lifestyle & Wellbeing", "keys": ["lifestyle_factors", "recent_travel", "vaccination_status",
+                                                         "mental_health", "sleep_patterns", "dietary_habits"]}
+        ]
+        self.questionnaire_mode = QUESTIONNAIRE_MODE if QUESTIONNAIRE_MODE in ("grouped", "single") else "grouped"
 
     def init_session_state(self):
         """Initialize session state variables"""
@@ -265,6 +1585,29 @@ class MediAssistChatbot:
         if 'diagnosis_result' not in st.session_state:
             st.session_state.diagnosis_result = None
 
+    @property
+    def storage(self) -> Optional[StorageBackend]:
+        """The configured storage backend, connected on first use"""
+        if self._storage is None:
+            try:
+                self._storage = get_storage_backend()
+            except Exception as e:
+                st.error(f"Failed to connect to database: {str(e)}")
+        return self._storage
+
+    @property
+    def chroma_manager(self) -> Optional[KnowledgeIndex]:
+        """The medical knowledge index, opened (and seeded if empty) at the first retrieval"""
+        if self._chroma_manager is None and DEPENDENCIES_AVAILABLE and VECTOR_BACKEND != "none":
+            try:
+                if VECTOR_BACKEND == "numpy":
+                    self._chroma_manager = get_numpy_vector_index()
+                else:
+                    self._chroma_manager = get_chroma_manager()
+            except Exception as e:
+                st.error(f"Failed to connect to databases: {str(e)}")
+        return self._chroma_manager
+
     def render_question(self, question: Dict[str, Any]) -> Any:
         """Render a question based on its type"""
         key = question["key"]
@@ -276,17 +1619,26 @@ class MediAssistChatbot:
         if required:
             q_text += " *"
         
+        # Pre-fill with the saved answer, so going Back shows (and resubmits) what was entered
+        saved = getattr(st.session_state.patient_data, key)
+        
         if q_type == "text":
-            return st.text_input(q_text, key=f"input_{key}")
+            return st.text_input(q_text, value=saved, key=f"input_{key}")
         elif q_type == "text_area":
-            return st.text_area(q_text, key=f"input_{key}", height=100)
+            return st.text_area(q_text, value=saved, key=f"input_{key}", height=100)
         elif q_type == "number":
             if key in ["weight", "height"]:
-                return st.number_input(q_text, min_value=0.0, max_value=300.0, step=0.1, key=f"input_{key}")
+                return st.number_input(q_text, min_value=0.0, max_value=300.0, step=0.1, value=float(saved),
+                                       key=f"input_{key}")
             else:
-                return st.number_input(q_text, min_value=1, max_value=120, key=f"input_{key}")
+                return st.number_input(q_text, min_value=1, max_value=120, value=max(int(saved), 1), key=f"input_{key}")
+        elif q_type == "date":
+            return st.date_input(q_text, value=date.fromisoformat(saved) if saved else None,
+                                 min_value=date(1900, 1, 1), max_value=date.today(), key=f"input_{key}")
         elif q_type == "select":
-            return st.selectbox(q_text, [""] + question["options"], key=f"input_{key}")
+            options = [""] + question["options"]
+            return st.selectbox(q_text, options, index=options.index(saved) if saved in options else 0,
+                                key=f"input_{key}")
         
         return None
 
@@ -299,19 +1651,190 @@ class MediAssistChatbot:
 
     def save_answer(self, key: str, value: Any):
         """Save answer to patient data"""
+        if key == "date_of_birth":
+            value = value.isoformat()
+            st.session_state.patient_data.age = age_on(value)
         setattr(st.session_state.patient_data, key, value)
 
+    def get_page_bounds(self) -> List[tuple]:
+        """Return (start, end) question indices for each questionnaire page"""
+        bounds = []
+        start = 0
+        for page in self.question_pages:
+            end = start + len(page["keys"])
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def get_page_index(self, question_index: int) -> int:
+        """Return the page containing the given question index"""
+        for page_index, (start, end) in enumerate(self.get_page_bounds()):
+            if start <= question_index < end:
+                return page_index
+        return len(self.question_pages) - 1
+
+    def render_single_question(self):
+        """Render the current question on its own (one rerun per answer)"""
+        current_q = self.questions[st.session_state.current_question]
+
+        with st.container():
+            st.markdown('<div class="question-container">', unsafe_allow_html=True)
+            st.subheader(f"Question {st.session_state.current_question + 1} of {len(self.questions)}")
+
+            # Render question
+            answer = self.render_question(current_q)
+
+            # Show required field indicator
+            if current_q.get("required", False):
+                st.markdown('<p class="required">* Required field</p>', unsafe_allow_html=True)
+
+            col1, col2, col3 = st.columns([1, 1, 1])
+
+            with col2:
+                if st.button("Next ➡️", type="primary", use_container_width=True, key="question_next"):
+                    if self.validate_answer(current_q, answer):
+                        self.save_answer(current_q["key"], answer)
+                        if current_q["key"] in CONTEXT_QUERY_KEYS:
+                            self.schedule_context_prefetch()
+                        st.session_state.current_question += 1
+                        st.rerun()
+                    else:
+                        st.error("Please provide an answer for this required field.")
+
+            # Back button
+            with col1:
+                if st.session_state.current_question > 0:
+                    if st.button("⬅️ Back", use_container_width=True, key="question_back"):
+                        st.session_state.current_question -= 1
+                        st.rerun()
+
+            st.markdown('</div>', unsafe_allow_html=True)
+
+    def render_question_page(self):
+        """Render the current page of related questions as a single form.
+
+        Widgets inside ``st.form`` do not trigger reruns, so a whole page costs
+        one rerun on submit instead of one per question.
+        """
+        page_index = self.get_page_index(st.session_state.current_question)
+        page = self.question_pages[page_index]
+        start, end = self.get_page_bounds()[page_index]
+        page_questions = self.questions[start:end]
+
+        with st.container():
+            st.markdown('<div class="question-container">', unsafe_allow_html=True)
+
+            with st.form(key=f"question_page_{page_index}"):
+                st.subheader(f"Step {page_index + 1} of {len(self.question_pages)}: {page['title']}")
+
+                # Render all questions on this page
+                answers = {q["key"]: self.render_question(q) for q in page_questions}
+
+                # Show required field indicator
+                if any(q.get("required", False) for q in page_questions):
+                    st.markdown('<p class="required">* Required field</p>', unsafe_allow_html=True)
+
+                col1, col2, col3 = st.columns([1, 1, 1])
+
+                with col1:
+                    back_clicked = st.form_submit_button("⬅️ Back", use_container_width=True, disabled=page_index == 0,
+                                                         key="questionnaire_back")
+                with col2:
+                    next_clicked = st.form_submit_button("Next ➡️", type="primary", use_container_width=True,
+                                                         key="questionnaire_next")
+
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        if back_clicked and page_index > 0:
+            st.session_state.current_question = self.get_page_bounds()[page_index - 1][0]
+            st.rerun()
+
+        if next_clicked:
+            missing = [q["question"] for q in page_questions if not self.validate_answer(q, answers[q["key"]])]
+            if missing:
+                st.error("Please provide an answer for these required fields:\n" + "\n".join(f"- {m}" for m in missing))
+            else:
+                for q in page_questions:
+                    self.save_answer(q["key"], answers[q["key"]])
+                if any(q["key"] in CONTEXT_QUERY_KEYS for q in page_questions):
+                    self.schedule_context_prefetch()
+                st.session_state.current_question = end
+                st.rerun()
+
     def get_medical_context_from_chroma(self, patient_data: PatientData) -> str:
         """Get medical context using ChromaDB RAG"""
         if not self.chroma_manager:
             return self._get_fallback_medical_context(patient_data)
         
-        # Create comprehensive symptom query
-        symptom_query = f"{patient_data.main_symptom} {patient_data.additional_symptoms} {patient_data.pain_location}".strip()
+        # One facet query per symptom/history answer, so a long multi-symptom
+        # description is not blurred into a single embedding
+        facets = {key: str(getattr(patient_data, key)) for key in CONTEXT_QUERY_KEYS}
         
         # Get relevant medical information
-        medical_context = self.chroma_manager.query_medical_knowledge(symptom_query, n_results=3)
+        medical_context = self.chroma_manager.query_medical_knowledge_facets(facets, n_results=3)
+        
+        return medical_context
+
+    def get_context_query_key(self, patient_data: PatientData) -> tuple:
+        """Return the answers the medical context depends on, used to detect stale prefetches"""
+        return tuple(str(getattr(patient_data, key)).strip() for key in CONTEXT_QUERY_KEYS)
+
+    def schedule_context_prefetch(self):
+        """Speculatively fetch medical context in the background while the user keeps answering"""
+        if not PREFETCH_ENABLED:
+            return
+        
+        patient_data = st.session_state.patient_data
+        if not patient_data.main_symptom or get_circuit_breakers()["chroma"].is_open:
+            return
+        
+        query_key = self.get_context_query_key(patient_data)
+        prefetch = st.session_state.get("context_prefetch")
+        if prefetch and prefetch["query_key"] == query_key:
+            return
+        
+        # Answers changed since the last speculation - discard it
+        if prefetch:
+            prefetch["future"].cancel()
+        
+        # Work on a snapshot so later answers cannot change the in-flight query
+        future = get_prefetch_executor().submit(self.get_medical_context_from_chroma, replace(patient_data))
+        st.session_state.context_prefetch = {"query_key": query_key, "future": future}
+
+    def get_medical_context(self, patient_data: PatientData, timeout: Optional[float] = None) -> str:
+        """Get medical context, using the speculative prefetch when it matches the final answers.
+
+        Falls back to the keyword context when retrieval fails, takes longer than
+        ``timeout`` seconds or its circuit breaker is open.
+        """
+        prefetch = st.session_state.pop("context_prefetch", None)
+        future = None
+        
+        if prefetch:
+            if prefetch["query_key"] == self.get_context_query_key(patient_data):
+                future = prefetch["future"]
+            else:
+                prefetch["future"].cancel()
+        
+        if not self.chroma_manager or not self.chroma_manager.is_available:
+            return self._get_fallback_medical_context(patient_data)
+        
+        breaker = get_circuit_breakers()["chroma"]
+        if future is None:
+            if not breaker.allow():
+                return self._get_fallback_medical_context(patient_data)
+            future = get_prefetch_executor().submit(self.get_medical_context_from_chroma, replace(patient_data))
+        
+        try:
+            medical_context = future.result(timeout=timeout)
+        except Exception:
+            medical_context = RETRIEVAL_ERROR  # Timed out, cancelled or raised
+        
+        if medical_context == RETRIEVAL_ERROR:
+            breaker.record_failure()
+            return self._get_fallback_medical_context(patient_data)
         
+        breaker.record_success()
         return medical_context
 
     def _get_fallback_medical_context(self, patient_data: PatientData) -> str:
@@ -333,8 +1856,9 @@ class MediAssistChatbot:
         
         return " | ".join(context_parts) if context_parts else "General symptom evaluation and supportive care recommended."
 
-    def call_openrouter_api(self, patient_data: PatientData, medical_context: str) -> Dict[str, Any]:
-        """Call OpenRouter API for comprehensive diagnosis"""
+    def call_openrouter_api(self, patient_data: PatientData, medical_context: str,
+                            timeout: float = LLM_TIMEOUT_SECONDS) -> Dict[str, Any]:
+        """Call OpenRouter API for comprehensive diagnosis, giving up after ``timeout`` seconds"""
         
         # Demo response with comprehensive information
         demo_response = {
@@ -393,6 +1917,12 @@ class MediAssistChatbot:
         if not DEPENDENCIES_AVAILABLE or not OPENROUTER_API_KEY or OPENROUTER_API_KEY == "your-openrouter-key":
             return demo_response
         
+        # Fail fast while OpenRouter is unhealthy or the assessment is out of time
+        breaker = get_circuit_breakers()["openrouter"]
+        if timeout < 1 or not breaker.allow():
+            st.warning("⚠️ The AI service is temporarily unavailable - showing general guidance instead.")
+            return demo_response
+        
         try:
             system_prompt = """
 You are MediAssist, an advanced AI medical assistant. Analyze patient data and medical context to provide comprehensive health assessment.
@@ -449,14 +1979,17 @@ Please provide a comprehensive medical assessment including prescribed medicatio
                 "temperature": 0.3
             }
             
+            import requests
+            
             response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
+                OPENROUTER_URL,
                 headers=headers,
                 json=data,
-                timeout=60
+                timeout=timeout
             )
             
             if response.status_code == 200:
+                breaker.record_success()
                 result = response.json()
                 content = result['choices'][0]['message']['content']
                 try:
@@ -464,69 +1997,64 @@ Please provide a comprehensive medical assessment including prescribed medicatio
                 except:
                     return demo_response
             else:
+                breaker.record_failure()
                 st.error(f"API Error: {response.status_code} - {response.text}")
                 return demo_response
                 
         except Exception as e:
+            breaker.record_failure()
             st.error(f"Error calling API: {str(e)}")
             return demo_response
 
-    def save_to_supabase(self, patient_data: PatientData, diagnosis_result: Dict[str, Any]):
-        """Save patient data and diagnosis to Supabase with better error handling"""
-        if not self.supabase:
-            st.warning("Supabase not connected - data not saved to database")
+    def save_assessment(self, patient_data: PatientData, diagnosis_result: Dict[str, Any],
+                        deadline: Optional[Deadline] = None):
+        """Save patient data and diagnosis to the configured storage backend.
+
+        While the storage is unhealthy (breaker open) or the assessment is out of
+        time, the record goes to the local spool instead.
+        """
+        if not self.storage:
+            st.warning("Database not connected - data not saved")
             return False
         
-        try:
-            # First, check if tables exist by trying to select from them
+        record = build_session_record(patient_data, diagnosis_result, st.session_state.get('session_id'))
+        breaker = get_circuit_breakers()["storage"]
+        error = None
+        
+        if (deadline is None or not deadline.expired) and breaker.allow():
             try:
-                test_query = self.supabase.table('patients').select("id").limit(1).execute()
-            except Exception as table_error:
-                st.error(f"Database tables not properly configured: {str(table_error)}")
-                st.info("Please ensure you've run the database setup SQL in your Supabase project.")
-                return False
-            
-            # Insert patient data
-            patient_insert_data = {
-                'name': patient_data.name,
-                'age': patient_data.age,
-                'gender': patient_data.gender,
-                'created_at': datetime.now().isoformat()
-            }
-            
-            patient_result = self.supabase.table('patients').insert(patient_insert_data).execute()
-            
-            if not patient_result.data:
-                st.error("Failed to insert patient data")
-                return False
-            
-            patient_id = patient_result.data[0]['id']
-            
-            # Insert symptom session
-            session_insert_data = {
-                'patient_id': patient_id,
-                'answers': asdict(patient_data),
-                'diagnosis': json.dumps(diagnosis_result.get('possible_diagnosis', [])),
-                'treatment': json.dumps(diagnosis_result.get('treatment_recommendations', [])),
-                'created_at': datetime.now().isoformat()
-            }
-            
-            session_result = self.supabase.table('symptom_sessions').insert(session_insert_data).execute()
-            
-            if session_result.data:
+                saved = self.storage.save_session(record)
+            except Exception as e:
+                breaker.record_failure()
+                error = e
+            else:
+                breaker.record_success()
+                st.session_state.patient_id = saved['patient_id']
                 st.success("✅ Data saved to database successfully")
                 return True
-            else:
-                st.error("Failed to insert symptom session data")
-                return False
-            
+        
+        try:
+            spool = get_spool_storage()
+            if spool is not None:
+                spool.save_session(record)
+                st.warning("⚠️ The database is unavailable - your assessment was saved locally and will be synced later.")
+                return True
         except Exception as e:
-            st.error(f"Error saving to database: {str(e)}")
-            st.info("This might be due to RLS policies or missing database setup. Check your Supabase configuration.")
-            return False
+            error = error or e
+        
+        st.error(f"Error saving to database: {str(error or 'the database is temporarily unavailable')}")
+        st.info(self.storage.setup_hint)
+        return False
 
     def generate_pdf_report(self, patient_data: PatientData, diagnosis_result: Dict[str, Any]) -> bytes:
         """Generate comprehensive PDF report"""
+        # reportlab is only needed when a report is actually requested
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4
+        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib.units import inch
+        
         buffer = io.BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
         
@@ -577,6 +2105,11 @@ Please provide a comprehensive medical assessment including prescribed medicatio
         story.append(Paragraph(f"<b>Severity:</b> {patient_data.symptom_severity}", styles['Normal']))
         story.append(Spacer(1, 20))
         
+        if diagnosis_result.get('emergency'):
+            story.append(Paragraph(f"<b>🚨 SEEK EMERGENCY CARE NOW</b> - {diagnosis_result.get('emergency_guidance', '')}",
+                                   styles['Normal']))
+            story.append(Spacer(1, 20))
+        
         # Possible Diagnoses
         story.append(Paragraph("🔍 Possible Conditions", heading_style))
         for diag in diagnosis_result.get('possible_diagnosis', []):
@@ -596,6 +2129,13 @@ Please provide a comprehensive medical assessment including prescribed medicatio
                 story.append(Spacer(1, 8))
             story.append(Spacer(1, 12))
         
+        # Safety screening findings
+        if diagnosis_result.get('safety_warnings'):
+            story.append(Paragraph("🛡️ Safety Checks", heading_style))
+            for warning in diagnosis_result['safety_warnings']:
+                story.append(Paragraph(f"• {warning}", styles['Normal']))
+            story.append(Spacer(1, 12))
+        
         # Home Remedies
         if 'home_remedies' in diagnosis_result and diagnosis_result['home_remedies']:
             story.append(Paragraph("🏠 Home Remedies", heading_style))
@@ -703,6 +2243,9 @@ Please provide a comprehensive medical assessment including prescribed medicatio
 
         self.init_session_state()
         
+        if EMBEDDING_WARMUP:
+            start_knowledge_warmup()
+        
         # Header
         st.markdown('<h1 class="main-header">🏥 MediAssist - Enhanced AI Health Assistant</h1>', unsafe_allow_html=True)
         st.markdown("*Comprehensive health guidance with AI-powered diagnosis, medication recommendations, and home remedies*")
@@ -710,10 +2253,19 @@ Please provide a comprehensive medical assessment including prescribed medicatio
         # Disclaimer
         st.warning("⚠️ **Important**: This tool provides general health information only and is not a substitute for professional medical advice, diagnosis, or treatment.")
         
-        # Show ChromaDB status
-        if self.chroma_manager and self.chroma_manager.collection:
-            st.success("✅ Enhanced medical knowledge base loaded (ChromaDB)")
-        else:
+        # Navigation
+        if self.clinician_authorized():
+            view = st.sidebar.radio("Navigation", ["🩺 Health Assessment", "📜 Patient History", "📊 Clinic Dashboard"],
+                                    key="nav_view")
+            if view == "📜 Patient History":
+                self.display_patient_history()
+                return
+            if view == "📊 Clinic Dashboard":
+                self.display_clinic_dashboard()
+                return
+        
+        # The knowledge index is only opened at the first retrieval, so just report the fallback here
+        if not DEPENDENCIES_AVAILABLE or VECTOR_BACKEND == "none":
             st.info("ℹ️ Using fallback medical knowledge base")
         
         # Progress bar
@@ -725,39 +2277,11 @@ Please provide a comprehensive medical assessment including prescribed medicatio
         # Main application logic
         if not st.session_state.diagnosis_complete:
             if st.session_state.current_question < len(self.questions):
-                # Show current question
-                current_q = self.questions[st.session_state.current_question]
-                
-                with st.container():
-                    st.markdown('<div class="question-container">', unsafe_allow_html=True)
-                    st.subheader(f"Question {st.session_state.current_question + 1} of {len(self.questions)}")
-                    
-                    # Render question
-                    answer = self.render_question(current_q)
-                    
-                    # Show required field indicator
-                    if current_q.get("required", False):
-                        st.markdown('<p class="required">* Required field</p>', unsafe_allow_html=True)
-                    
-                    col1, col2, col3 = st.columns([1, 1, 1])
-                    
-                    with col2:
-                        if st.button("Next ➡️", type="primary", use_container_width=True):
-                            if self.validate_answer(current_q, answer):
-                                self.save_answer(current_q["key"], answer)
-                                st.session_state.current_question += 1
-                                st.rerun()
-                            else:
-                                st.error("Please provide an answer for this required field.")
-                    
-                    # Back button
-                    with col1:
-                        if st.session_state.current_question > 0:
-                            if st.button("⬅️ Back", use_container_width=True):
-                                st.session_state.current_question -= 1
-                                st.rerun()
-                    
-                    st.markdown('</div>', unsafe_allow_html=True)
+                # Show current question (or page of questions)
+                if self.questionnaire_mode == "grouped":
+                    self.render_question_page()
+                else:
+                    self.render_single_question()
             
             else:
                 # All questions completed - show summary and get diagnosis
@@ -790,22 +2314,42 @@ Please provide a comprehensive medical assessment including prescribed medicatio
                     st.write("• Personalized medication recommendations")
                     st.write("• Safe home remedy suggestions")
                     
-                    if st.button("🩺 Get My Comprehensive Health Assessment", type="primary", use_container_width=True):
+                    if st.button("🩺 Get My Comprehensive Health Assessment", type="primary", use_container_width=True,
+                                 key="get_assessment"):
                         with st.spinner("Analyzing your symptoms with advanced medical AI..."):
-                            # Get medical context from ChromaDB
-                            medical_context = self.get_medical_context_from_chroma(patient_data)
+                            # One time budget for the whole chain; each stage gets its share
+                            deadline = Deadline(ASSESSMENT_DEADLINE_SECONDS)
                             
-                            # Get comprehensive diagnosis from AI
-                            diagnosis_result = self.call_openrouter_api(patient_data, medical_context)
+                            # Local red-flag screening first - emergencies skip retrieval and the LLM
+                            emergencies = self.safety.screen_patient(patient_data) if self.safety else []
+                            
+                            if emergencies:
+                                prefetch = st.session_state.pop("context_prefetch", None)
+                                if prefetch:
+                                    prefetch["future"].cancel()
+                                diagnosis_result = self.safety.emergency_assessment(patient_data, emergencies)
+                            else:
+                                # Get medical context from ChromaDB (usually already prefetched)
+                                medical_context = self.get_medical_context(
+                                    patient_data, timeout=deadline.stage_timeout(RETRIEVAL_TIMEOUT_SECONDS))
+                                
+                                # Get comprehensive diagnosis from AI
+                                diagnosis_result = self.call_openrouter_api(
+                                    patient_data, medical_context, timeout=deadline.stage_timeout(LLM_TIMEOUT_SECONDS))
+                                
+                                # Drop medications that clash with allergies or current medications
+                                if self.safety:
+                                    diagnosis_result = self.safety.apply(patient_data, diagnosis_result)
                             
                             # Save to session state
                             st.session_state.diagnosis_result = diagnosis_result
                             st.session_state.diagnosis_complete = True
                             
                             # Save to database
-                            self.save_to_supabase(patient_data, diagnosis_result)
+                            self.save_assessment(patient_data, diagnosis_result, deadline)
                             
-                            time.sleep(2)  # Allow user to see the analysis process
+                            if not emergencies:
+                                time.sleep(2)  # Allow user to see the analysis process
                             st.rerun()
         
         else:
@@ -820,6 +2364,9 @@ Please provide a comprehensive medical assessment including prescribed medicatio
         st.markdown('<div class="diagnosis-container">', unsafe_allow_html=True)
         st.header("🩺 Your Comprehensive Health Assessment")
         
+        if result.get('emergency'):
+            st.error(f"🚨 **SEEK EMERGENCY CARE NOW** - {result.get('emergency_guidance', '')}")
+        
         # Patient summary
         st.subheader("👤 Patient Summary")
         col1, col2, col3 = st.columns(3)
@@ -855,6 +2402,12 @@ Please provide a comprehensive medical assessment including prescribed medicatio
                 st.write(f"**⚠️ Precautions:** {med['precautions']}")
                 st.markdown('</div>', unsafe_allow_html=True)
         
+        # Safety screening findings
+        if result.get('safety_warnings'):
+            st.subheader("🛡️ Safety Checks")
+            for warning in result['safety_warnings']:
+                st.warning(warning)
+        
         # Home Remedies
         if 'home_remedies' in result and result['home_remedies']:
             st.subheader("🏠 Natural Home Remedies")
@@ -936,6 +2489,388 @@ Please provide a comprehensive medical assessment including prescribed medicatio
             if st.button("📞 Emergency Help", use_container_width=True):
                 st.error("🚨 **Emergency Numbers:**\n- Emergency: 911 (US) / 102 (India)\n- Poison Control: 1-800-222-1222 (US)\n- Crisis Helpline: 988 (US)")
 
+    def clinician_authorized(self) -> bool:
+        """Whether this session may open the clinician views"""
+        if not CLINICIAN_VIEWS:
+            return False
+        if not CLINICIAN_ACCESS_CODE or st.session_state.get('clinician_authorized'):
+            return True
+        
+        code = st.sidebar.text_input("Clinician access code", type="password", key="clinician_code")
+        if code and hmac.compare_digest(code.encode("utf-8"), CLINICIAN_ACCESS_CODE.encode("utf-8")):
+            st.session_state.clinician_authorized = True
+            return True
+        if code:
+            st.sidebar.error("Incorrect access code")
+        return False
+
+    def display_patient_history(self):
+        """Display a patient's previous assessments, one keyset page at a time"""
+        st.header("📜 Patient History")
+        
+        if not self.storage:
+            st.info("ℹ️ Patient history requires a database connection.")
+            return
+        
+        patient_id = st.text_input("Patient ID", value=st.session_state.get('patient_id', ''), key="history_patient_id").strip()
+        if not patient_id:
+            st.info("Enter a patient ID to view their assessment history.")
+            return
+        
+        # Stack of cursors for the pages visited so far; reset when the patient changes
+        if st.session_state.get('history_for') != patient_id:
+            st.session_state.history_for = patient_id
+            st.session_state.history_cursors = [None]
+        
+        try:
+            rows, next_cursor = self.storage.get_history(patient_id, st.session_state.history_cursors[-1])
+        except Exception as e:
+            st.error(f"Error loading patient history: {str(e)}")
+            return
+        
+        if not rows:
+            st.info("No assessments found for this patient.")
+        
+        for row in rows:
+            with st.expander(f"{row['created_at'][:16].replace('T', ' ')} - {row.get('main_symptom') or 'Assessment'}"):
+                st.write(f"**Severity:** {row.get('symptom_severity') or 'Not recorded'}")
+                for diag in row.get('diagnosis') or []:
+                    st.write(f"• **{diag.get('condition', '')}** - {diag.get('probability', '')}")
+                for i, rec in enumerate(row.get('treatment') or [], 1):
+                    st.write(f"{i}. {rec}")
+        
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col1:
+            if len(st.session_state.history_cursors) > 1:
+                if st.button("⬅️ Newer", use_container_width=True):
+                    st.session_state.history_cursors.pop()
+                    st.rerun()
+        with col3:
+            if next_cursor:
+                if st.button("Older ➡️", use_container_width=True):
+                    st.session_state.history_cursors.append(next_cursor)
+                    st.rerun()
+
+    def display_clinic_dashboard(self):
+        """Display clinic-wide analytics aggregated in the database"""
+        st.header("📊 Clinic Dashboard")
+        
+        self.display_upstream_health()
+        
+        if not self.storage:
+            st.info("ℹ️ The clinic dashboard requires a database connection.")
+            return
+        
+        days = st.selectbox("Period", [7, 30, 90, 365], index=1, format_func=lambda d: f"Last {d} days", key="dashboard_days")
+        
+        try:
+            analytics = self.storage.get_analytics(days)
+        except Exception as e:
+            st.error(f"Error loading analytics: {str(e)}")
+            return
+        
+        per_day = analytics['sessions_per_day']
+        st.metric("Assessments", sum(row['sessions'] for row in per_day))
+        
+        st.subheader("📈 Sessions per Day")
+        if per_day:
+            st.line_chart({'day': [row['day'] for row in per_day], 'sessions': [row['sessions'] for row in per_day]},
+                          x='day', y='sessions')
+        else:
+            st.info("No assessments in this period.")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.subheader("🔍 Top Conditions")
+            for row in analytics['top_conditions']:
+                st.write(f"• **{row['condition']}** - {row['sessions']}")
+        with col2:
+            st.subheader("🌡️ Severity Distribution")
+            severity = [row for row in analytics['severity_distribution'] if row['severity'] is not None]
+            if severity:
+                st.bar_chart({'severity': [row['severity'] for row in severity], 'sessions': [row['sessions'] for row in severity]},
+                             x='severity', y='sessions')
+
+
+    def display_upstream_health(self):
+        """Show circuit breaker state per dependency and the local spool backlog"""
+        st.subheader("🩺 Upstream Health")
+        state_labels = {"closed": "🟢 Healthy", "half_open": "🟡 Recovering", "open": "🔴 Failing fast"}
+        breakers = [breaker.metrics() for breaker in get_circuit_breakers().values()]
+        
+        for col, metrics in zip(st.columns(len(breakers)), breakers):
+            with col:
+                st.metric(metrics['name'].capitalize(), state_labels[metrics['state']])
+                st.caption(f"{metrics['calls']} calls · {metrics['failures']} failures · "
+                           f"{metrics['rejected']} rejected · opened {metrics['opened']}×")
+        
+        try:
+            spool = get_spool_storage()
+            pending = spool.session_count() if spool else 0
+        except Exception:
+            pending = 0
+        if pending:
+            st.warning(f"⚠️ {pending} assessment(s) waiting in the local spool - run `python manage.py drain-spool`.")
+
+# Patient identity resolution: single round-trip save and duplicate merge job
+patient_identity_functions_sql = """
+create extension if not exists pgcrypto;
+
+-- Upsert the patient by identity key and record the session in one transaction
+drop function if exists save_symptom_session(text, text, int, text, float, float, jsonb, jsonb, jsonb, jsonb, jsonb, text);
+drop function if exists save_symptom_session(text, text, int, text, float, float, jsonb, jsonb, jsonb, jsonb, jsonb, text, timestamp with time zone);
+create or replace function save_symptom_session(
+  p_patient_key text,
+  p_name text,
+  p_age int,
+  p_gender text,
+  p_weight float,
+  p_height float,
+  p_answers jsonb,
+  p_diagnosis jsonb,
+  p_treatment jsonb,
+  p_medications jsonb,
+  p_home_remedies jsonb,
+  p_session_id text,
+  p_created_at timestamp with time zone default null,
+  p_date_of_birth date default null
+)
+returns jsonb
+language plpgsql as $$
+declare
+  v_patient_id uuid;
+  v_session_id uuid;
+begin
+  insert into patients as p (patient_key, name, date_of_birth, age, gender, weight, height)
+  values (p_patient_key, p_name, p_date_of_birth, p_age, p_gender, p_weight, p_height)
+  on conflict (patient_key) do update
+    set name = excluded.name,
+        date_of_birth = coalesce(excluded.date_of_birth, p.date_of_birth),
+        age = excluded.age,
+        weight = coalesce(excluded.weight, p.weight),
+        height = coalesce(excluded.height, p.height)
+  returning p.id into v_patient_id;
+
+  insert into symptom_sessions (patient_id, answers, diagnosis, treatment, medications, home_remedies, session_id, created_at)
+  values (v_patient_id, p_answers, p_diagnosis, p_treatment, p_medications, p_home_remedies, p_session_id,
+          coalesce(p_created_at, timezone('utc'::text, now())))
+  returning id into v_session_id;
+
+  return jsonb_build_object('patient_id', v_patient_id, 'session_id', v_session_id);
+end
+$$;
+
+-- Batch variant: a jsonb array of session records saved in one call and one transaction
+create or replace function save_symptom_sessions_bulk(p_records jsonb)
+returns int
+language plpgsql as $$
+declare
+  r jsonb;
+  v_count int := 0;
+begin
+  for r in select * from jsonb_array_elements(p_records) loop
+    perform save_symptom_session(
+      r->>'patient_key', r->>'name', (r->>'age')::int, r->>'gender',
+      (r->>'weight')::float, (r->>'height')::float,
+      r->'answers', r->'diagnosis', r->'treatment', r->'medications', r->'home_remedies',
+      r->>'session_id', (r->>'created_at')::timestamp with time zone, (r->>'date_of_birth')::date
+    );
+    v_count := v_count + 1;
+  end loop;
+  return v_count;
+end
+$$;
+
+-- Merge duplicate patient rows of the same person (one row per session before
+-- identity resolution) and re-point their sessions to the row that is kept.
+-- Rows with a date of birth are keyed with the same formula as
+-- patient_identity_key() in app.py; the oldest row per key is kept. Legacy rows
+-- without one only have the age at their visit, so their birth year is estimated
+-- as year(created_at) - age: rows with the same name and gender whose estimate is
+-- within a year of the first row of their group are merged into that row, and
+-- their patient_key is left as is.
+create or replace function merge_duplicate_patients()
+returns int
+language plpgsql as $$
+declare
+  v_merged int;
+  r record;
+  v_person text;
+  v_birth_year int;
+  v_keep_id uuid;
+begin
+  create temporary table patient_keys on commit drop as
+    select id, created_at, encode(digest(
+      lower(regexp_replace(btrim(name), '\\s+', ' ', 'g')) || '|' ||
+      lower(btrim(gender)) || '|' ||
+      to_char(date_of_birth, 'YYYY-MM-DD'), 'sha256'), 'hex') as key
+    from patients
+    where date_of_birth is not null;
+
+  create temporary table patient_merge on commit drop as
+    select id, first_value(id) over (partition by key order by created_at, id) as keep_id
+    from patient_keys;
+  delete from patient_merge where id = keep_id;
+
+  for r in
+    select id, lower(regexp_replace(btrim(name), '\\s+', ' ', 'g')) || '|' || lower(btrim(gender)) as person,
+           extract(year from created_at)::int - age as birth_year
+    from patients
+    where date_of_birth is null and age is not null
+    order by person, birth_year, created_at, id
+  loop
+    if r.person is distinct from v_person or r.birth_year - v_birth_year > 1 then
+      v_person := r.person;
+      v_birth_year := r.birth_year;
+      v_keep_id := r.id;
+    else
+      insert into patient_merge (id, keep_id) values (r.id, v_keep_id);
+    end if;
+  end loop;
+
+  update symptom_sessions s set patient_id = m.keep_id from patient_merge m where s.patient_id = m.id;
+  delete from patients p using patient_merge m where p.id = m.id;
+  get diagnostics v_merged = row_count;
+
+  update patients p set patient_key = k.key from patient_keys k
+  where p.id = k.id and p.patient_key is distinct from k.key;
+
+  return v_merged;
+end
+$$;
+"""
+
+# Patient history and clinic dashboard: indexes, the daily rollup and RPCs. Every
+# statement is idempotent, so this also runs as-is on existing databases
+# (history_migration_sql); each run rebuilds the rollup with one pass over the sessions.
+history_functions_sql = """
+-- Export/dashboard range scans in (created_at, id) order; replaces the single-column index
+create index if not exists symptom_sessions_created_at_id_idx on symptom_sessions(created_at, id);
+drop index if exists symptom_sessions_created_at_idx;
+
+-- Keyset pagination of a patient's history: (patient_id, created_at, id) seek
+create index if not exists symptom_sessions_patient_history_idx on symptom_sessions(patient_id, created_at desc, id desc);
+
+-- No query filters on answers/diagnosis containment; the dashboard reads session_daily_stats instead
+drop index if exists symptom_sessions_answers_gin_idx;
+drop index if exists symptom_sessions_diagnosis_gin_idx;
+
+-- Older rows stored the diagnosis and treatment arrays as JSON-encoded strings; normalise to an array
+create or replace function diagnosis_items(d jsonb) returns jsonb
+language sql immutable as $$
+  select case jsonb_typeof(d)
+    when 'array' then d
+    when 'string' then (d #>> '{}')::jsonb
+    else '[]'::jsonb
+  end
+$$;
+
+-- Per-patient history, newest first. Pass the (created_at, id) of the last row
+-- of the previous page to get the next one.
+create or replace function patient_session_history(
+  p_patient_id uuid,
+  p_before_created_at timestamp with time zone default null,
+  p_before_id uuid default null,
+  p_limit int default 10
+)
+returns table (id uuid, created_at timestamp with time zone, main_symptom text, symptom_severity text, diagnosis jsonb, treatment jsonb)
+language sql stable as $$
+  select s.id, s.created_at, s.answers->>'main_symptom', s.answers->>'symptom_severity',
+         diagnosis_items(s.diagnosis), diagnosis_items(s.treatment)
+  from symptom_sessions s
+  where s.patient_id = p_patient_id
+    and (p_before_created_at is null or (s.created_at, s.id) < (p_before_created_at, p_before_id))
+  order by s.created_at desc, s.id desc
+  limit least(p_limit, 100)
+$$;
+
+-- Clinic dashboard rollup: session counts per UTC day, top condition and severity,
+-- kept current by a trigger. The dashboard reads at most days x conditions x
+-- severities rows, however many sessions there are. '' and 0 stand for unknown.
+create table if not exists session_daily_stats (
+  day date not null,
+  condition text not null default '',
+  severity int not null default 0,
+  sessions bigint not null default 0,
+  primary key (day, condition, severity)
+);
+
+create or replace function session_condition(d jsonb) returns text
+language sql immutable as $$
+  select coalesce(diagnosis_items(d)->0->>'condition', '')
+$$;
+
+create or replace function session_severity(a jsonb) returns int
+language sql immutable as $$
+  select coalesce(substring(a->>'symptom_severity' from '^\\s*(\\d+)')::int, 0)
+$$;
+
+create or replace function session_daily_stats_apply() returns trigger
+language plpgsql as $$
+begin
+  if tg_op = 'INSERT' then
+    insert into session_daily_stats as d (day, condition, severity, sessions)
+    values ((new.created_at at time zone 'utc')::date, session_condition(new.diagnosis), session_severity(new.answers), 1)
+    on conflict (day, condition, severity) do update set sessions = d.sessions + 1;
+    return new;
+  end if;
+  update session_daily_stats set sessions = sessions - 1
+  where day = (old.created_at at time zone 'utc')::date
+    and condition = session_condition(old.diagnosis)
+    and severity = session_severity(old.answers);
+  return old;
+end
+$$;
+
+-- (Re)build the rollup from the sessions; inserts wait until it is done, so no session is counted twice or missed
+begin;
+lock table symptom_sessions in share row exclusive mode;
+drop trigger if exists symptom_sessions_daily_stats on symptom_sessions;
+truncate session_daily_stats;
+insert into session_daily_stats (day, condition, severity, sessions)
+  select (s.created_at at time zone 'utc')::date, session_condition(s.diagnosis), session_severity(s.answers), count(*)
+  from symptom_sessions s
+  group by 1, 2, 3;
+create trigger symptom_sessions_daily_stats after insert or delete on symptom_sessions
+  for each row execute function session_daily_stats_apply();
+commit;
+
+-- Clinic dashboard aggregates over the last p_days UTC days (today included), read from the rollup
+create or replace function sessions_per_day(p_days int default 30)
+returns table (day date, sessions bigint)
+language sql stable as $$
+  select d.day, sum(d.sessions)::bigint
+  from session_daily_stats d
+  where d.day > (now() at time zone 'utc')::date - p_days
+  group by 1
+  having sum(d.sessions) > 0
+  order by 1
+$$;
+
+create or replace function top_conditions(p_days int default 30, p_limit int default 10)
+returns table (condition text, sessions bigint)
+language sql stable as $$
+  select d.condition, sum(d.sessions)::bigint
+  from session_daily_stats d
+  where d.day > (now() at time zone 'utc')::date - p_days
+    and d.condition <> ''
+  group by 1
+  having sum(d.sessions) > 0
+  order by 2 desc
+  limit p_limit
+$$;
+
+create or replace function severity_distribution(p_days int default 30)
+returns table (severity int, sessions bigint)
+language sql stable as $$
+  select nullif(d.severity, 0), sum(d.sessions)::bigint
+  from session_daily_stats d
+  where d.day > (now() at time zone 'utc')::date - p_days
+  group by 1
+  having sum(d.sessions) > 0
+  order by 1
+$$;
+"""
 
 # Database setup SQL with enhanced schema
 database_setup_sql = """
@@ -953,7 +2888,9 @@ drop table if exists medical_knowledge;
 -- Patients table with enhanced fields
 create table patients (
   id uuid primary key default uuid_generate_v4(),
+  patient_key text unique,
   name text not null,
+  date_of_birth date,
   age int not null,
   gender text not null,
   weight float,
@@ -988,9 +2925,9 @@ create table medical_knowledge (
 -- Create indexes for better performance
 create index patients_created_at_idx on patients(created_at);
 create index symptom_sessions_patient_id_idx on symptom_sessions(patient_id);
-create index symptom_sessions_created_at_idx on symptom_sessions(created_at);
 create index medical_knowledge_category_idx on medical_knowledge(category);
 
+""" + history_functions_sql + """
 -- Enable Row Level Security (RLS) - Disable for testing, enable in production
 -- alter table patients enable row level security;
 -- alter table symptom_sessions enable row level security;
@@ -1011,6 +2948,18 @@ insert into medical_knowledge (title, content, category, conditions) values
 ('Fever Management', 'Fever treatment includes rest, hydration, acetaminophen 500-1000mg every 6 hours, ibuprofen 400-600mg every 8 hours. Monitor temperature regularly.', 'symptom_management', '{"fever","flu","infection"}'),
 ('Headache Treatment', 'Headache relief through hydration, rest in dark room, acetaminophen or ibuprofen, identify triggers. Seek help for sudden severe headaches.', 'symptom_management', '{"headache","migraine"}'),
 ('Respiratory Infections', 'Upper respiratory infections require supportive care, rest, fluids, throat lozenges, steam inhalation, honey for cough.', 'condition_treatment', '{"cold","flu","cough","respiratory"}');
+""" + patient_identity_functions_sql
+
+# Run on databases created before the history/dashboard views; keeps existing data
+history_migration_sql = history_functions_sql
+
+# Run once on databases created before patient identity resolution
+patient_identity_migration_sql = """
+alter table patients add column if not exists patient_key text;
+alter table patients add column if not exists date_of_birth date;
+""" + patient_identity_functions_sql + """
+select merge_duplicate_patients();
+create unique index if not exists patients_patient_key_key on patients(patient_key);
 """
 
 # Main execution
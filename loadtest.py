@@ -0,0 +1,334 @@
+# MediAssist - Concurrent load test harness
+#
+# Drives virtual users through the full intake and the assessment with
+# Streamlit's AppTest, against local stubs: an in-process HTTP server standing
+# in for OpenRouter, SQLite instead of Supabase, and the keyword fallback
+# instead of Chroma. AppTest shares one fake runtime per process and is not
+# thread-safe, so each virtual user runs in its own process (all writing the
+# same SQLite file) and reports that process's resident memory.
+#
+# Usage:
+#   python loadtest.py [--levels 1,2,4,8] [--iterations 2] [--save-baseline loadtest_baseline.json]
+#   python loadtest.py --compare loadtest_baseline.json [--tolerance 0.2]
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# One answer per question key; selects must match an option exactly
+ANSWERS = {
+    "name": "Load Test Patient",
+    "date_of_birth": date(1983, 4, 12),
+    "gender": "Other",
+    "weight": 70.0,
+    "height": 175.0,
+    "main_symptom": "Persistent dry cough and sore throat for several days",
+    "additional_symptoms": "Mild fever, fatigue",
+    "symptom_duration": "4-7 days",
+    "symptom_severity": "4 - Moderate",
+    "pain_location": "Throat, scratchy",
+    "symptom_triggers": "Worse at night",
+    "medical_history": "None",
+    "current_medications": "None",
+    "allergies": "None known",
+    "family_history": "None",
+    "lifestyle_factors": "Non-smoker, office job",
+    "recent_travel": "No",
+    "vaccination_status": "Fully up to date",
+    "mental_health": "Good",
+    "sleep_patterns": "Some difficulty sleeping",
+    "dietary_habits": "No changes",
+}
+
+STUB_DIAGNOSIS = {
+    "possible_diagnosis": [{"condition": "Viral Upper Respiratory Infection", "probability": "70%", "description": "Stub"}],
+    "prescribed_medications": [],
+    "home_remedies": [],
+    "treatment_recommendations": ["Rest and fluids"],
+    "red_flags": ["Difficulty breathing"],
+    "lifestyle_recommendations": [],
+    "follow_up_care": [],
+    "disclaimer": "Load test stub response.",
+}
+
+_script_runs = 0
+
+
+class _OpenRouterStub(BaseHTTPRequestHandler):
+    """Answers chat completion requests with a canned diagnosis after a fixed delay"""
+
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({"choices": [{"message": {"content": json.dumps(STUB_DIAGNOSIS)}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_openrouter_stub(latency: float) -> ThreadingHTTPServer:
+    _OpenRouterStub.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _OpenRouterStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _count_script_runs():
+    """Count script executions (every rerun calls st.set_page_config exactly once)"""
+    import streamlit as st
+
+    original = st.set_page_config
+
+    def counting_set_page_config(*args, **kwargs):
+        global _script_runs
+        _script_runs += 1
+        return original(*args, **kwargs)
+
+    st.set_page_config = counting_set_page_config
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        # Peak RSS (KB on Linux, bytes on macOS) when /proc is unavailable
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _fill(at, key: str, value) -> bool:
+    """Answer a question if its widget is on the current page"""
+    for kind in ("text_input", "text_area", "number_input", "date_input", "selectbox"):
+        try:
+            widget = getattr(at, kind)(key=f"input_{key}")
+        except KeyError:
+            continue
+        if kind == "selectbox":
+            widget.select(value)
+        elif kind in ("number_input", "date_input"):
+            widget.set_value(value)
+        else:
+            widget.input(value)
+        return True
+    return False
+
+
+def _button(at, *keys):
+    for key in keys:
+        try:
+            return at.button(key=key)
+        except KeyError:
+            continue
+    raise RuntimeError(f"None of the buttons {keys} is on the page")
+
+
+def run_intake(timeout: float) -> dict:
+    """Drive one virtual user through the questionnaire and the assessment"""
+    from streamlit.testing.v1 import AppTest
+
+    latencies = []
+
+    def timed(step: str, action):
+        start = time.perf_counter()
+        action()
+        latencies.append((step, time.perf_counter() - start))
+        if at.exception:
+            raise RuntimeError(f"{step}: {at.exception[0].message}")
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    timed("load", at.run)
+
+    while at.session_state["current_question"] < len(ANSWERS):
+        before = at.session_state["current_question"]
+        for key, value in ANSWERS.items():
+            _fill(at, key, value)
+        timed("question", lambda: _button(at, "questionnaire_next", "question_next").click().run())
+        if at.session_state["current_question"] == before:
+            errors = "; ".join(e.value for e in at.error)
+            raise RuntimeError(f"Questionnaire did not advance: {errors}")
+
+    timed("assessment", lambda: at.button(key="get_assessment").click().run())
+    if not at.session_state["diagnosis_complete"]:
+        raise RuntimeError("Assessment did not complete")
+
+    return {"latencies": latencies, "app": at}
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": ordered[-1] * 1000, "count": len(ordered)}
+
+
+def _virtual_user(iterations: int, timeout: float) -> dict:
+    """One virtual user, run in its own process: ``iterations`` intakes back to back"""
+    from streamlit.testing.v1 import AppTest  # noqa: F401 - import before the clock starts
+
+    _count_script_runs()
+    results = []
+    start = time.time()
+    for _ in range(iterations):
+        try:
+            results.append(run_intake(timeout))
+        except Exception as e:
+            results.append({"error": str(e)})
+    end = time.time()
+    # Measured while the last session's AppTest is still alive
+    rss = _current_rss_mb()
+    return {
+        "results": [{key: value for key, value in result.items() if key != "app"} for result in results],
+        "reruns": _script_runs,
+        "start": start,
+        "end": end,
+        "rss_mb": rss,
+    }
+
+
+def run_level(concurrency: int, iterations: int, timeout: float) -> dict:
+    """Run ``concurrency`` virtual users in separate processes, each completing ``iterations`` intakes"""
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=get_context("spawn")) as pool:
+        users = list(pool.map(_virtual_user, [iterations] * concurrency, [timeout] * concurrency))
+
+    # From the first user starting its intakes to the last one finishing (process start-up excluded)
+    wall = max(user["end"] for user in users) - min(user["start"] for user in users)
+    reruns = sum(user["reruns"] for user in users)
+    rss = [user["rss_mb"] for user in users]
+
+    results = [result for user in users for result in user["results"]]
+    completed = [r for r in results if "latencies" in r]
+    failures = [r["error"] for r in results if "error" in r]
+    by_step = {}
+    for result in completed:
+        for step, seconds in result["latencies"]:
+            by_step.setdefault(step, []).append(seconds)
+
+    return {
+        "concurrency": concurrency,
+        "sessions": len(results),
+        "completed": len(completed),
+        "failed": len(failures),
+        "errors": sorted(set(failures))[:5],
+        "wall_seconds": wall,
+        "reruns": reruns,
+        "reruns_per_sec": reruns / wall if wall else 0.0,
+        "rss_per_user_mb": sum(rss) / len(rss),
+        "rss_max_mb": max(rss),
+        "latency_ms": {
+            **{step: _percentiles(values) for step, values in by_step.items()},
+            "all": _percentiles([s for values in by_step.values() for s in values]),
+        },
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """List regressions of reruns/sec or p90 step latency beyond ``tolerance``"""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        base = baseline_levels.get(level["concurrency"])
+        if not base:
+            continue
+        if level["reruns_per_sec"] < base["reruns_per_sec"] * (1 - tolerance):
+            regressions.append(f"c={level['concurrency']}: reruns/sec {level['reruns_per_sec']:.1f} "
+                               f"< baseline {base['reruns_per_sec']:.1f}")
+        for step, stats in level["latency_ms"].items():
+            base_stats = base["latency_ms"].get(step)
+            if base_stats and stats and stats["p90"] > base_stats["p90"] * (1 + tolerance):
+                regressions.append(f"c={level['concurrency']}: {step} p90 {stats['p90']:.0f} ms "
+                                   f"> baseline {base_stats['p90']:.0f} ms")
+        if level["failed"] > base["failed"]:
+            regressions.append(f"c={level['concurrency']}: {level['failed']} failed sessions "
+                               f"(baseline {base['failed']})")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="MediAssist concurrent load test")
+    parser.add_argument("--levels", default="1,2,4,8", help="Comma-separated concurrency levels to ramp through")
+    parser.add_argument("--iterations", type=int, default=2, help="Intakes per virtual user at each level")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds the OpenRouter stub waits")
+    parser.add_argument("--timeout", type=float, default=60, help="Per-rerun timeout in seconds")
+    parser.add_argument("--questionnaire-mode", choices=["grouped", "single"], default="grouped")
+    parser.add_argument("--save-baseline", help="Write the report to this JSON file")
+    parser.add_argument("--compare", help="Compare against a baseline JSON file; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args(argv)
+
+    stub = _start_openrouter_stub(args.llm_latency)
+    workdir = tempfile.mkdtemp(prefix="mediassist-loadtest-")
+    os.environ.update({
+        "OPENROUTER_API_KEY": "loadtest-key",
+        "OPENROUTER_URL": f"http://127.0.0.1:{stub.server_address[1]}/api/v1/chat/completions",
+        "MEDIASSIST_STORAGE": "sqlite",
+        "MEDIASSIST_SQLITE_PATH": os.path.join(workdir, "loadtest.db"),
+        "MEDIASSIST_VECTOR_BACKEND": "none",
+        "MEDIASSIST_QUESTIONNAIRE_MODE": args.questionnaire_mode,
+    })
+
+    levels = [int(level) for level in args.levels.split(",")]
+    report = {
+        "config": {
+            "levels": levels,
+            "iterations": args.iterations,
+            "llm_latency": args.llm_latency,
+            "questionnaire_mode": args.questionnaire_mode,
+            "python": sys.version.split()[0],
+        },
+        "levels": [],
+    }
+
+    for concurrency in levels:
+        level = run_level(concurrency, args.iterations, args.timeout)
+        report["levels"].append(level)
+        overall = level["latency_ms"].get("all", {})
+        print(f"c={concurrency:<3} sessions={level['completed']}/{level['sessions']} "
+              f"reruns/s={level['reruns_per_sec']:.1f} "
+              f"p50={overall.get('p50', 0):.0f}ms p90={overall.get('p90', 0):.0f}ms p99={overall.get('p99', 0):.0f}ms "
+              f"rss/user={level['rss_per_user_mb']:.0f}MB (max {level['rss_max_mb']:.0f}MB)")
+        for error in level["errors"]:
+            print(f"    error: {error}")
+
+    stub.shutdown()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+# MediAssist - Admin commands
+#
+# Usage:
+#   python manage.py dedupe-patients
+#   python manage.py bench-storage [--sessions 20000] [--batch-size 500]
+#   python manage.py rebuild-index
+#   python manage.py index-recall [--k 3] [--queries queries.txt]
+#   python manage.py export-vector-snapshot [--out ./vector_snapshot]
+#   python manage.py warm-up [--server http://localhost:8501] [--timeout 300]
+#   python manage.py export-sessions --format parquet --out sessions.parquet [--since 2025-01-01] [--until 2025-02-01]
+#   python manage.py drain-spool [--batch-size 500]
+#   python manage.py import-budget [--max-extra-ms 500] [--max-extra-modules 40]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import replace
+
+import app
+
+# Modules that must only be imported at first use, never when app.py loads
+LAZY_MODULES = ["reportlab", "chromadb", "supabase", "onnxruntime", "requests"]
+# Allowed first-run cost of app.py over a trivial Streamlit script
+IMPORT_BUDGET_EXTRA_MS = 500
+IMPORT_BUDGET_EXTRA_MODULES = 40
+
+# Held-out queries for measuring index recall (override with --queries)
+RECALL_QUERIES = [
+    "high fever and chills for three days",
+    "throbbing headache behind the eyes with light sensitivity",
+    "dry cough that gets worse at night",
+    "nausea and vomiting after eating",
+    "sharp pain in the lower right abdomen",
+    "runny nose, sore throat and congestion",
+    "itchy rash and swelling after eating peanuts",
+    "loose stools and stomach cramps",
+    "trouble falling asleep and waking up tired",
+    "lower back pain after lifting",
+    "burning feeling in the chest after meals",
+    "body aches and fatigue with mild fever",
+]
+
+
+def dedupe_patients(args) -> int:
+    """Merge duplicate patient rows created before identity resolution"""
+    storage = app.SupabaseStorage(app.SUPABASE_URL, app.SUPABASE_KEY)
+    merged = storage.client.rpc('merge_duplicate_patients', {}).execute().data
+    print(f"Merged {merged or 0} duplicate patient rows")
+    return 0
+
+
+def bench_storage(args) -> int:
+    """Measure SQLite backend throughput for single saves, bulk inserts and history reads"""
+    template = app.PatientData(name="Bench Patient", date_of_birth="1985-06-15", age=40, gender="Other", main_symptom="headache",
+                               symptom_severity="4 - Moderate")
+    diagnosis = {'possible_diagnosis': [{'condition': 'Tension Headache', 'probability': '60%'}]}
+    records = [
+        app.build_session_record(replace(template, name=f"Bench Patient {i % args.patients}"), diagnosis, f"bench-{i}")
+        for i in range(args.sessions)
+    ]
+    single = records[:args.single]
+    bulk = records[args.single:]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = app.SQLiteStorage(os.path.join(tmp, "bench.db"))
+
+        start = time.perf_counter()
+        for record in single:
+            storage.save_session(record)
+        single_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(0, len(bulk), args.batch_size):
+            storage.bulk_insert(bulk[i:i + args.batch_size])
+        bulk_elapsed = time.perf_counter() - start
+
+        patient_id = storage.save_session(records[0])['patient_id']
+        start = time.perf_counter()
+        pages = 0
+        cursor = None
+        while True:
+            _, cursor = storage.get_history(patient_id, cursor, page_size=10)
+            pages += 1
+            if not cursor:
+                break
+        history_elapsed = time.perf_counter() - start
+
+    print(f"single save:  {len(single) / single_elapsed:10.0f} sessions/s ({len(single)} sessions)")
+    print(f"bulk insert:  {len(bulk) / bulk_elapsed:10.0f} sessions/s ({len(bulk)} sessions, batch {args.batch_size})")
+    print(f"history page: {history_elapsed / pages * 1000:10.2f} ms/page ({pages} pages)")
+    return 0
+
+
+def _knowledge_manager(allow_layout_change: bool = False):
+    manager = app.ChromaDBManager(allow_layout_change=allow_layout_change)
+    if not manager.client:
+        raise SystemExit("ChromaDB is not available")
+    return manager
+
+
+def rebuild_index(args) -> int:
+    """Rebuild the knowledge collections with the configured HNSW and sharding settings.
+
+    Also the way to switch MEDIASSIST_CHROMA_SHARD_BY_CATEGORY: the documents are
+    moved into the newly selected layout.
+    """
+    manager = _knowledge_manager(allow_layout_change=True)
+    start = time.perf_counter()
+    count = manager.rebuild_index(batch_size=args.batch_size)
+    print(f"Rebuilt {count} documents into {len(manager.collections)} collection(s) "
+          f"(M={app.HNSW_M}, construction_ef={app.HNSW_CONSTRUCTION_EF}, search_ef={app.HNSW_SEARCH_EF}) "
+          f"in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+def index_recall(args) -> int:
+    """Report HNSW recall@k against exact search on a held-out query set"""
+    queries = RECALL_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    report = _knowledge_manager().measure_recall(queries, k=args.k)
+    print(f"recall@{report['k']}: {report['recall']:.3f} over {report['queries']} queries, "
+          f"{report['documents']} documents, {report['ann_latency_ms']:.2f} ms/query")
+    return 0 if report['recall'] >= args.min_recall else 1
+
+
+def export_vector_snapshot(args) -> int:
+    """Export the Chroma knowledge collections to a memory-mappable NumPy snapshot"""
+    manager = _knowledge_manager()
+    count = app.NumpyVectorIndex.export_snapshot(manager, args.out)
+    print(f"Exported {count} documents to {args.out}")
+    return 0
+
+
+def _open_server_session(server: str, timeout: float):
+    """Run the app once on a live Streamlit server, like a browser opening it, over its websocket"""
+    import websocket
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+    url = server.rstrip("/").replace("https://", "wss://", 1).replace("http://", "ws://", 1) + "/_stcore/stream"
+    connection = websocket.create_connection(url, timeout=timeout)
+    try:
+        rerun = BackMsg()
+        rerun.rerun_script.query_string = ""
+        rerun.rerun_script.page_script_hash = ""
+        connection.send_binary(rerun.SerializeToString())
+        while True:
+            message = ForwardMsg()
+            message.ParseFromString(connection.recv())
+            if message.WhichOneof("type") == "script_finished":
+                return
+    finally:
+        connection.close()
+
+
+def warm_up(args) -> int:
+    """Load the embedding model ahead of time.
+
+    Without --server, downloads and loads the model in this process (e.g. in an
+    image build or init container), which fills the model cache but does not
+    signal readiness. With --server, opens one session on the running app (e.g.
+    from a postStart hook) so the serving process starts its own warm-up, then
+    waits for the MEDIASSIST_READY_FILE that only the serving process writes.
+    """
+    start = time.perf_counter()
+    if not args.server:
+        app.warm_up_embeddings()
+        print(f"Embedding model ready in {time.perf_counter() - start:.2f}s "
+              f"(intra-op threads: {app.ONNX_INTRA_OP_THREADS or 'default'}, "
+              f"inter-op threads: {app.ONNX_INTER_OP_THREADS or 'default'})")
+        return 0
+
+    _open_server_session(args.server, args.timeout)
+    print(f"Started the warm-up on {args.server}")
+    if not app.READY_FILE:
+        return 0
+    while not os.path.exists(app.READY_FILE):
+        if time.perf_counter() - start > args.timeout:
+            print(f"FAIL: {app.READY_FILE} not written within {args.timeout:.0f}s")
+            return 1
+        time.sleep(0.5)
+    print(f"Server ready in {time.perf_counter() - start:.2f}s ({app.READY_FILE})")
+    return 0
+
+
+def export_sessions(args) -> int:
+    """Stream sessions from the configured storage backend to CSV, JSONL or Parquet"""
+    storage = app.get_storage_backend()
+    if storage is None:
+        raise SystemExit("No storage backend available")
+
+    fmt = args.format or os.path.splitext(args.out)[1].lstrip(".")
+    start = time.perf_counter()
+    count = app.write_sessions_export(storage, args.out, fmt, since=args.since, until=args.until,
+                                      page_size=args.page_size, row_group_size=args.row_group_size)
+    print(f"Exported {count} sessions to {args.out} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+def drain_spool(args) -> int:
+    """Replay assessments spooled locally during a storage outage into the primary storage.
+
+    Each batch is deleted from the spool only after the bulk insert succeeded, so
+    an interrupted drain can be re-run without losing sessions.
+    """
+    spool = app.get_spool_storage()
+    storage = app.get_storage_backend()
+    if spool is None or storage is None:
+        raise SystemExit("No spool configured (MEDIASSIST_SPOOL_PATH) or no primary storage backend")
+
+    drained = 0
+    while True:
+        batch = spool.fetch_records(limit=args.batch_size)
+        if not batch:
+            break
+        storage.bulk_insert([record for _, record in batch])
+        drained += spool.delete_sessions([session_row_id for session_row_id, _ in batch])
+    print(f"Drained {drained} spooled sessions")
+    return 0
+
+
+# Baseline for the import budget: Streamlit running a trivial script
+BASELINE_SCRIPT = "import streamlit as st\nst.write('baseline')\n"
+
+
+def _measure_first_run(script_path: str = "") -> dict:
+    """Run a script once in a fresh interpreter the way Streamlit does (as __main__, via AppTest).
+
+    Reports the wall time of the first run and the modules loaded by then. Without
+    ``script_path`` the trivial BASELINE_SCRIPT is run instead. The background
+    knowledge warm-up is switched off: it runs off the request path, and its
+    imports would otherwise race the module snapshot.
+    """
+    code = (
+        "import json, sys, time\n"
+        "from streamlit.testing.v1 import AppTest\n"
+        f"at = AppTest.from_file({script_path!r}) if {script_path!r} else AppTest.from_string({BASELINE_SCRIPT!r})\n"
+        "start = time.perf_counter()\n"
+        "at.run(timeout=120)\n"
+        "print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules),\n"
+        "                  'errors': [e.message for e in at.exception]}))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, "MEDIASSIST_EMBEDDING_WARMUP": "false"}).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_budget(args) -> int:
+    """Fail if the first run of app.py costs much more than a trivial Streamlit script"""
+    app_path = os.path.abspath(app.__file__)
+    baseline = min((_measure_first_run() for _ in range(args.repeat)), key=lambda r: r['seconds'])
+    measured = min((_measure_first_run(app_path) for _ in range(args.repeat)), key=lambda r: r['seconds'])
+
+    extra_ms = (measured['seconds'] - baseline['seconds']) * 1000
+    extra_modules = sorted(set(measured['modules']) - set(baseline['modules']))
+    eager_heavy = sorted({m.split('.')[0] for m in extra_modules} & set(LAZY_MODULES))
+
+    print(f"baseline:  {baseline['seconds'] * 1000:.0f} ms, {len(baseline['modules'])} modules")
+    print(f"app:       {measured['seconds'] * 1000:.0f} ms, {len(measured['modules'])} modules "
+          f"(+{extra_ms:.0f} ms, +{len(extra_modules)} modules)")
+
+    failures = [f"first run raised: {error}" for error in measured['errors']]
+    if extra_ms > args.max_extra_ms:
+        failures.append(f"first run over budget: +{extra_ms:.0f} ms > {args.max_extra_ms} ms")
+    if len(extra_modules) > args.max_extra_modules:
+        failures.append(f"module count over budget: +{len(extra_modules)} > {args.max_extra_modules} "
+                        f"({', '.join(extra_modules)})")
+    if eager_heavy:
+        failures.append(f"heavy modules imported on the first run: {', '.join(eager_heavy)}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="MediAssist admin commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    dedupe_parser = subparsers.add_parser("dedupe-patients", help="Merge duplicate patient rows in Supabase")
+    dedupe_parser.set_defaults(func=dedupe_patients)
+
+    bench_parser = subparsers.add_parser("bench-storage", help="Benchmark the SQLite storage backend")
+    bench_parser.add_argument("--sessions", type=int, default=20000, help="Total sessions to write")
+    bench_parser.add_argument("--patients", type=int, default=1000, help="Distinct patients")
+    bench_parser.add_argument("--single", type=int, default=1000, help="Sessions written one save at a time")
+    bench_parser.add_argument("--batch-size", type=int, default=500, help="Sessions per bulk insert transaction")
+    bench_parser.set_defaults(func=bench_storage)
+
+    rebuild_parser = subparsers.add_parser("rebuild-index", help="Rebuild/compact the medical knowledge index")
+    rebuild_parser.add_argument("--batch-size", type=int, default=1000, help="Documents per read/write batch")
+    rebuild_parser.set_defaults(func=rebuild_index)
+
+    recall_parser = subparsers.add_parser("index-recall", help="Measure index recall against exact search")
+    recall_parser.add_argument("--k", type=int, default=3, help="Results per query")
+    recall_parser.add_argument("--queries", help="File with one held-out query per line")
+    recall_parser.add_argument("--min-recall", type=float, default=0.0, help="Exit non-zero below this recall")
+    recall_parser.set_defaults(func=index_recall)
+
+    export_parser = subparsers.add_parser("export-vector-snapshot", help="Build the NumPy vector index snapshot from Chroma")
+    export_parser.add_argument("--out", default=app.VECTOR_SNAPSHOT_DIR, help="Snapshot directory")
+    export_parser.set_defaults(func=export_vector_snapshot)
+
+    warm_up_parser = subparsers.add_parser("warm-up", help="Download and load the embedding model")
+    warm_up_parser.add_argument("--server", help="Warm up this running app instead (e.g. http://localhost:8501)")
+    warm_up_parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the readiness file")
+    warm_up_parser.set_defaults(func=warm_up)
+
+    export_sessions_parser = subparsers.add_parser("export-sessions", help="Stream sessions to CSV, JSONL or Parquet")
+    export_sessions_parser.add_argument("--out", required=True, help="Output file")
+    export_sessions_parser.add_argument("--format", choices=["csv", "jsonl", "parquet"],
+                                        help="Output format (default: from the file extension)")
+    export_sessions_parser.add_argument("--since", help="Include sessions created at or after this ISO date/time")
+    export_sessions_parser.add_argument("--until", help="Include sessions created before this ISO date/time")
+    export_sessions_parser.add_argument("--page-size", type=int, default=1000, help="Rows per keyset page")
+    export_sessions_parser.add_argument("--row-group-size", type=int, default=50000, help="Rows per Parquet row group")
+    export_sessions_parser.set_defaults(func=export_sessions)
+
+    drain_parser = subparsers.add_parser("drain-spool", help="Replay locally spooled assessments into the primary storage")
+    drain_parser.add_argument("--batch-size", type=int, default=500, help="Sessions per bulk insert")
+    drain_parser.set_defaults(func=drain_spool)
+
+    budget_parser = subparsers.add_parser("import-budget", help="Check the first run's time and loaded modules")
+    budget_parser.add_argument("--max-extra-ms", type=float, default=IMPORT_BUDGET_EXTRA_MS,
+                               help="Allowed first-run time over a trivial script")
+    budget_parser.add_argument("--max-extra-modules", type=int, default=IMPORT_BUDGET_EXTRA_MODULES,
+                               help="Allowed modules over a trivial script")
+    budget_parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (fastest is used)")
+    budget_parser.set_defaults(func=import_budget)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
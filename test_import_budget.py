@@ -0,0 +1,44 @@
+# MediAssist - Regression test for the cost of the app's first run (see
+# `python manage.py import-budget`, which prints the same measurement).
+#
+# Usage:
+#   python -m pytest -q test_import_budget.py
+
+import os
+
+import pytest
+
+import app
+import manage
+
+
+@pytest.fixture(scope="module")
+def first_runs():
+    """Fastest of three first runs each for a trivial script and for app.py"""
+    def fastest(script_path=""):
+        return min((manage._measure_first_run(script_path) for _ in range(3)), key=lambda run: run["seconds"])
+
+    return fastest(), fastest(os.path.abspath(app.__file__))
+
+
+def test_first_run_completes_without_errors(first_runs):
+    _, measured = first_runs
+    assert measured["errors"] == []
+
+
+def test_first_run_time_budget(first_runs):
+    baseline, measured = first_runs
+    extra_ms = (measured["seconds"] - baseline["seconds"]) * 1000
+    assert extra_ms <= manage.IMPORT_BUDGET_EXTRA_MS
+
+
+def test_first_run_module_budget(first_runs):
+    baseline, measured = first_runs
+    extra_modules = set(measured["modules"]) - set(baseline["modules"])
+    assert len(extra_modules) <= manage.IMPORT_BUDGET_EXTRA_MODULES, sorted(extra_modules)
+
+
+def test_heavy_modules_stay_unloaded(first_runs):
+    baseline, measured = first_runs
+    loaded = {module.split(".")[0] for module in set(measured["modules"]) - set(baseline["modules"])}
+    assert loaded.isdisjoint(manage.LAZY_MODULES), sorted(loaded & set(manage.LAZY_MODULES))
@@ -0,0 +1,187 @@
+# MediAssist - Tests for the local safety rules (red-flag screening and the
+# medication post-filter) and for the emergency short-circuit in the app.
+#
+# Usage:
+#   python -m pytest -q
+
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import loadtest
+from app import SAFETY_RULES_PATH, PatientData, SafetyRuleEngine
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return SafetyRuleEngine.from_file(SAFETY_RULES_PATH)
+
+
+def flags(engine, main_symptom, severity="5 - Moderate", **answers):
+    patient = PatientData(main_symptom=main_symptom, symptom_severity=severity, **answers)
+    return [match["id"] for match in engine.screen_patient(patient)]
+
+
+@pytest.mark.parametrize("main_symptom, expected", [
+    ("Crushing chest pain spreading to my left arm", ["cardiac_chest_pain"]),
+    ("Worst headache of my life, came on suddenly", ["thunderclap_headache"]),
+    ("My face is drooping and I have slurred speech", ["stroke"]),
+    ("I fainted at work this morning", ["consciousness"]),
+    ("Coughing up blood since yesterday", ["bleeding"]),
+    ("Sore throat and a runny nose", []),
+])
+def test_red_flags_match_symptoms(engine, main_symptom, expected):
+    assert flags(engine, main_symptom) == expected
+
+
+@pytest.mark.parametrize("main_symptom", [
+    "No chest pain, just a runny nose",
+    "I don't have any chest pain",
+    "Patient denies chest pain",
+    "I have had seizures in the past",
+    "History of fainting as a teenager",
+])
+def test_negated_and_historical_mentions_are_ignored(engine, main_symptom):
+    assert flags(engine, main_symptom) == []
+
+
+@pytest.mark.parametrize("main_symptom", [
+    "Never had chest pain like this before",
+    "No relief from the chest pain",
+    "Not just indigestion - crushing chest pain",
+    "previously healthy man with crushing chest pain",
+    "No fever but crushing chest pressure",
+])
+def test_cues_not_attached_to_the_match_do_not_suppress_it(engine, main_symptom):
+    assert flags(engine, main_symptom) == ["cardiac_chest_pain"]
+
+
+def test_history_cue_only_covers_its_own_mention(engine):
+    assert flags(engine, "Had a seizure years ago, fainted today") == ["consciousness"]
+
+
+def test_required_pattern_must_be_asserted(engine):
+    assert flags(engine, "Headache", additional_symptoms="Stiff neck, sensitive to light") == ["meningitis"]
+    assert flags(engine, "Headache", additional_symptoms="No stiff neck") == []
+    assert flags(engine, "Headache") == []
+
+
+def test_self_harm_is_flagged_even_when_negated(engine):
+    assert flags(engine, "Low mood", mental_health="I don't want to hurt myself but I think about it") == ["self_harm"]
+
+
+def test_min_severity(engine):
+    assert flags(engine, "Shortness of breath", severity="7 - Severe") == ["breathing"]
+    assert flags(engine, "Shortness of breath", severity="3 - Mild-moderate") == []
+    assert flags(engine, "I can't breathe and my lips are turning blue", severity="5 - Moderate") == ["respiratory_distress"]
+    assert flags(engine, "Gasping for air", severity="2 - Mild") == ["respiratory_distress"]
+    assert flags(engine, "Stomach pain", severity="8 - Very severe") == []
+    assert flags(engine, "Stomach pain", severity="10 - Unbearable") == ["severe_abdominal_pain"]
+
+
+def names(medications):
+    return [medication["name"] for medication in medications]
+
+
+def test_allergy_removes_medication_class(engine):
+    patient = PatientData(allergies="Penicillin (rash)")
+    kept, warnings = engine.filter_medications(patient, [{"name": "Amoxicillin 500mg"}, {"name": "Paracetamol 500mg"}])
+    assert names(kept) == ["Paracetamol 500mg"]
+    assert warnings == ["Removed Amoxicillin 500mg: reported allergy (penicillin)"]
+
+
+def test_allergy_by_name_outside_known_classes(engine):
+    patient = PatientData(allergies="Loratadine")
+    kept, warnings = engine.filter_medications(patient, [{"name": "Loratadine 10mg"}])
+    assert kept == []
+    assert warnings == ["Removed Loratadine 10mg: reported allergy (loratadine)"]
+
+
+@pytest.mark.parametrize("allergies, medication", [
+    ("No known allergies", "Known Allergy Relief"),
+    ("Seasonal allergies", "Seasonal Allergy Spray"),
+])
+def test_allergy_by_name_ignores_placeholders_and_generic_words(engine, allergies, medication):
+    kept, warnings = engine.filter_medications(PatientData(allergies=allergies), [{"name": medication}])
+    assert names(kept) == [medication]
+    assert warnings == []
+
+
+def test_allergy_by_name_matches_any_drug_word(engine):
+    patient = PatientData(allergies="Reacted badly to cetirizine")
+    kept, warnings = engine.filter_medications(patient, [{"name": "Allergy Relief (Cetirizine 10mg)"}])
+    assert kept == []
+    assert warnings == ["Removed Allergy Relief (Cetirizine 10mg): reported allergy (cetirizine)"]
+
+
+def test_remove_interaction_with_current_medications(engine):
+    patient = PatientData(current_medications="Warfarin 5mg daily")
+    kept, warnings = engine.filter_medications(patient, [{"name": "Ibuprofen 400mg"}])
+    assert kept == []
+    assert warnings[0].startswith("Removed Ibuprofen 400mg: interacts with current medications")
+
+
+def test_warn_interaction_keeps_medication(engine):
+    patient = PatientData(current_medications="Sertraline 50mg")
+    kept, warnings = engine.filter_medications(patient, [{"name": "Ibuprofen 400mg"}])
+    assert names(kept) == ["Ibuprofen 400mg"]
+    assert warnings == ["Caution with Ibuprofen 400mg: interacts with current medications - increased risk of stomach bleeding"]
+
+
+@pytest.mark.parametrize("current, suggested, expected", [
+    ("Aspirin 81mg daily", ["Ibuprofen 400mg"], []),
+    ("None", ["Ibuprofen 400mg", "Naproxen 250mg"], ["Ibuprofen 400mg"]),
+])
+def test_second_nsaid_is_removed(engine, current, suggested, expected):
+    patient = PatientData(current_medications=current)
+    kept, warnings = engine.filter_medications(patient, [{"name": name} for name in suggested])
+    assert names(kept) == expected
+    assert len(warnings) == 1 and "two NSAIDs" in warnings[0]
+
+
+def test_apply_keeps_existing_warnings(engine):
+    result = engine.apply(PatientData(allergies="aspirin"), {
+        "prescribed_medications": [{"name": "Naproxen 250mg"}],
+        "safety_warnings": ["from the model"],
+    })
+    assert result["prescribed_medications"] == []
+    assert result["safety_warnings"] == ["from the model", "Removed Naproxen 250mg: reported allergy (nsaid)"]
+
+
+class _CountingStub(loadtest._OpenRouterStub):
+    calls = 0
+
+    def do_POST(self):
+        type(self).calls += 1
+        super().do_POST()
+
+
+@pytest.fixture
+def app_env(monkeypatch, tmp_path):
+    """Run the app against SQLite, the keyword fallback and a counting OpenRouter stub"""
+    _CountingStub.calls = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _CountingStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    monkeypatch.setenv("OPENROUTER_URL", f"http://127.0.0.1:{server.server_address[1]}/api/v1/chat/completions")
+    monkeypatch.setenv("MEDIASSIST_STORAGE", "sqlite")
+    monkeypatch.setenv("MEDIASSIST_SQLITE_PATH", os.path.join(tmp_path, "test.db"))
+    monkeypatch.setenv("MEDIASSIST_VECTOR_BACKEND", "none")
+    yield monkeypatch
+    server.shutdown()
+
+
+def test_emergency_skips_the_llm(app_env):
+    app_env.setitem(loadtest.ANSWERS, "main_symptom", "Crushing chest pain since this morning")
+    result = loadtest.run_intake(timeout=60)["app"].session_state["diagnosis_result"]
+    assert result["emergency"] is True
+    assert result["red_flags"] == ["Chest pain, pressure or tightness"]
+    assert _CountingStub.calls == 0
+
+
+def test_routine_intake_calls_the_llm(app_env):
+    result = loadtest.run_intake(timeout=60)["app"].session_state["diagnosis_result"]
+    assert not result.get("emergency")
+    assert _CountingStub.calls == 1